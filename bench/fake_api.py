@@ -0,0 +1,60 @@
+import itertools
+import random
+import time
+from collections import Counter
+from threading import Lock, local
+
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+
+BOT_TOKEN = '123456:BENCHMARKBENCHMARKBENCHMARKBENCHMARK'
+
+
+class FakeApi:
+    def __init__(self, retry_after_rate: float = 0.0, latency: float = 0.0):
+        self.retry_after_rate = retry_after_rate
+        self.latency = latency
+        self.calls = Counter()
+        self.retry_afters = 0
+        self.outage = False  # every send hits a flood wait that never lifts
+        self._ids = itertools.count(1)
+        self._lock = Lock()
+        self._local = local()
+
+    @property
+    def thread_calls(self) -> int:
+        return getattr(self._local, 'calls', 0)
+
+    def post(self, url: str, data: dict):
+        method = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self.calls[method] += 1
+            message_id = next(self._ids)
+        self._local.calls = self.thread_calls + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            if self.outage:
+                raise RetryAfter(0)
+            if self.retry_after_rate and random.random() < self.retry_after_rate:
+                with self._lock:
+                    self.retry_afters += 1
+                raise RetryAfter(1)
+            chat_id = int(data.get('chat_id', 0))
+            return {'message_id': data.get('message_id', message_id), 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')}
+        return True
+
+
+class FakeRequest(Request):
+    # PTB warns about every new attribute on its objects, so the state lives in FakeApi
+    __slots__ = ('api',)
+
+    def __init__(self, api: FakeApi = None):
+        super().__init__(con_pool_size=64)
+        self.api = api or FakeApi()
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        return self.api.post(url, data)
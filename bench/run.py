@@ -0,0 +1,263 @@
+import argparse
+import io
+import itertools
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import timedelta
+from queue import Queue as UpdateQueue
+from threading import Lock, local
+
+from sqlalchemy import event
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+from bench.fake_api import FakeApi, FakeRequest, BOT_TOKEN
+from src.db.db_session import global_init, create_session, get_engine
+
+_ids = itertools.count(1)
+_queries = local()
+
+
+def _count_query(*_):
+    _queries.value = getattr(_queries, 'value', 0) + 1
+
+
+def message(user_id: int, text: str) -> dict:
+    data = {'message_id': next(_ids), 'date': int(time.time()), 'text': text,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}}
+    if text.startswith('/'):
+        data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': next(_ids), 'message': data}
+
+
+def callback(user_id: int, data: str, message_id: int) -> dict:
+    return {'update_id': next(_ids), 'callback_query': {
+        'id': str(next(_ids)), 'chat_instance': 'bench', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'},
+        'message': {'message_id': message_id or 1, 'date': int(time.time()), 'text': '',
+                    'chat': {'id': user_id, 'type': 'private'}}}}
+
+
+class Recorder:
+    def __init__(self, api: FakeApi):
+        self.api = api
+        self.scenario = None
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = Lock()
+
+    def wrap(self, func, name: str):
+        def wrapper(update, context):
+            queries, calls = getattr(_queries, 'value', 0), self.api.thread_calls
+            started = time.perf_counter()
+            try:
+                return func(update, context)
+            except Exception:
+                with self._lock:
+                    self.errors[(self.scenario, name)] += 1
+                raise
+            finally:
+                sample = (time.perf_counter() - started, getattr(_queries, 'value', 0) - queries,
+                          self.api.thread_calls - calls)
+                with self._lock:
+                    self.samples[(self.scenario, name)].append(sample)
+
+        return wrapper
+
+    def instrument(self, conv_handler):
+        handlers = list(conv_handler.entry_points) + list(conv_handler.fallbacks)
+        for state_handlers in conv_handler.states.values():
+            handlers.extend(state_handlers)
+        for handler in handlers:
+            handler.callback = self.wrap(handler.callback, handler.callback.__qualname__)
+
+    def report(self) -> list:
+        rows = []
+        for (scenario, name), samples in sorted(self.samples.items()):
+            latencies = sorted(sample[0] * 1000 for sample in samples)
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+            rows.append({'scenario': scenario, 'handler': name, 'updates': len(samples),
+                         'p50_ms': percentile(50), 'p95_ms': percentile(95),
+                         'p99_ms': percentile(99),
+                         'queries_per_update': sum(s[1] for s in samples) / len(samples),
+                         'api_calls_per_update': sum(s[2] for s in samples) / len(samples),
+                         'errors': self.errors.get((scenario, name), 0)})
+        return rows
+
+
+class Bench:
+    def __init__(self, users: int, concurrency: int, retry_after_rate: float, latency: float):
+        from main import build_conversation_handler
+        from src.persistence import DBPersistence
+
+        self.users = range(1000, 1000 + users)
+        self.concurrency = concurrency
+        self.api = FakeApi(retry_after_rate, latency)
+        self.bot = Bot(BOT_TOKEN, request=FakeRequest(self.api))
+        self.persistence = DBPersistence()
+        self.dispatcher = Dispatcher(self.bot, UpdateQueue(), persistence=self.persistence)
+        self.recorder = Recorder(self.api)
+        conv_handler = build_conversation_handler()
+        self.recorder.instrument(conv_handler)
+        self.dispatcher.add_handler(conv_handler)
+        event.listen(get_engine(), 'before_cursor_execute', _count_query)
+
+    def send(self, update: dict):
+        self.dispatcher.process_update(Update.de_json(update, self.bot))
+
+    def message_id(self, user_id: int):
+        return self.dispatcher.user_data[user_id].get('message_id')
+
+    def run(self, scenario: str, steps):
+        self.recorder.scenario = scenario
+        started = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            list(executor.map(steps, self.users))
+        elapsed = time.perf_counter() - started
+        print(f'[bench] {scenario}: {len(self.users)} users in {elapsed:.2f}s')
+
+    def registration(self, user_id: int):
+        self.send(message(user_id, '/start'))
+        self.send(message(user_id, f'Name{user_id}'))
+        self.send(message(user_id, f'Surname{user_id}'))
+
+    def menu(self, user_id: int):
+        for _ in range(3):
+            self.send(message(user_id, '/start'))
+
+    def pagination(self, user_id: int):
+        self.send(callback(user_id, 'archived', self.message_id(user_id)))
+        for data in ('next_page', 'next_page', 'prev_page', 'back'):
+            self.send(callback(user_id, data, self.message_id(user_id)))
+
+    def search(self, user_id: int):
+        self.send(message(user_id, 'archived 1'))
+        self.send(callback(user_id, 'back', self.message_id(user_id)))
+
+    def burst(self, user_id: int):
+        self.send(callback(user_id, f'reg {self.burst_queue_id}', self.message_id(user_id)))
+
+    def seed(self, archived: int):
+        from src.cache import invalidate_status_counts
+        from src.db.models.queue import Queue
+        from src.utils import local_now
+
+        now = local_now()
+        with create_session() as session:
+            for i in range(archived):
+                session.add(Queue(name=f'Archived {i}', notify_dt=now - timedelta(days=2),
+                                  start_dt=now - timedelta(days=1), end_dt=now - timedelta(hours=1),
+                                  notification_sent=True, status='archived'))
+            burst_queue = Queue(name='Burst', notify_dt=now - timedelta(hours=1), start_dt=now,
+                                end_dt=now + timedelta(hours=1), notification_sent=True,
+                                status='active')
+            session.add(burst_queue)
+            session.commit()
+            self.burst_queue_id = burst_queue.id
+        invalidate_status_counts()
+
+    def check_burst(self) -> bool:
+        from src.db.models.attendant import Attendant
+
+        with create_session() as session:
+            positions = [att.position for att in session.query(Attendant).filter(
+                Attendant.queue_id == self.burst_queue_id)]
+        return len(positions) == len(self.users) and len(set(positions)) == len(positions)
+
+    def check_outage(self, broadcasts: int = 3) -> bool:
+        # Deliveries that run out of retries on our side must not count against the chats
+        import src.broadcast
+        from src.db.models.queue import Queue
+        from src.db.models.user import User
+        from src.outbox import Outbox
+        from src.queue import notify_queue
+        from src.utils import local_now
+
+        limiter = src.broadcast.limiter
+        rate, chat_interval = limiter.rate, limiter.chat_interval
+        limiter.rate, limiter.chat_interval = 1e6, 0
+        outbox = Outbox(max_attempts=1)
+        outbox.bot = self.bot
+        self.api.outage = True
+        now = local_now()
+        try:
+            with redirect_stdout(io.StringIO()):
+                for i in range(broadcasts):
+                    with create_session() as session:
+                        queue = Queue(name=f'Outage {i}', notify_dt=now,
+                                      start_dt=now + timedelta(hours=1),
+                                      end_dt=now + timedelta(hours=2))
+                        session.add(queue)
+                        session.commit()
+                        queue_id = queue.id
+                    notify_queue(self.bot, queue_id)
+                    while outbox.drain():
+                        pass
+        finally:
+            self.api.outage = False
+            limiter.rate, limiter.chat_interval = rate, chat_interval
+        with create_session() as session:
+            return not session.query(User).filter(
+                User.id.in_([str(user_id) for user_id in self.users]) &
+                ((User.reachable.is_(False)) | (User.failed_deliveries > 0))).count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the bot against a fake Bot API')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--archived', type=int, default=45)
+    parser.add_argument('--retry-after-rate', type=float, default=0.0)
+    parser.add_argument('--api-latency', type=float, default=0.0)
+    parser.add_argument('--database', default=None, help='SQLAlchemy URL, a temporary SQLite '
+                                                         'file is used by default')
+    parser.add_argument('--json', default=None, help='write the report to this file')
+    args = parser.parse_args()
+
+    database = args.database or f'sqlite:///{tempfile.mkdtemp()}/bench.db'
+    global_init(database)
+    bench = Bench(args.users, args.concurrency, args.retry_after_rate, args.api_latency)
+    bench.seed(args.archived)
+    bench.run('registration', bench.registration)
+    bench.run('menu', bench.menu)
+    bench.run('pagination', bench.pagination)
+    bench.run('search', bench.search)
+    bench.run('burst', bench.burst)
+    bench.persistence.flush()
+
+    from src.registration import pipeline
+
+    rows = bench.recorder.report()
+    print(f'{"scenario":<13}{"handler":<30}{"updates":>8}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+          f'{"q/upd":>8}{"api/upd":>9}{"errors":>8}')
+    for row in rows:
+        print(f'{row["scenario"]:<13}{row["handler"]:<30}{row["updates"]:>8}'
+              f'{row["p50_ms"]:>9.2f}{row["p95_ms"]:>9.2f}{row["p99_ms"]:>9.2f}'
+              f'{row["queries_per_update"]:>8.2f}{row["api_calls_per_update"]:>9.2f}'
+              f'{row["errors"]:>8}')
+    summary = {'users': args.users, 'concurrency': args.concurrency, 'database': database,
+               'api_calls': dict(bench.api.calls), 'retry_afters': bench.api.retry_afters,
+               'registration_p99_ms': pipeline.percentile(99) * 1000,
+               'burst_positions_unique': bench.check_burst(),
+               'users_reachable_after_outage': bench.check_outage(), 'handlers': rows}
+    print(f'[bench] registration pipeline p99: {summary["registration_p99_ms"]:.2f} ms, '
+          f'unique burst positions: {summary["burst_positions_unique"]}, '
+          f'users reachable after outage: {summary["users_reachable_after_outage"]}')
+    pipeline.stop()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    os.environ.setdefault('super_admin_id', '')
+    main()
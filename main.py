@@ -1,68 +1,56 @@
-import json
 import os
-from datetime import datetime, timedelta
+from datetime import timedelta
+from queue import Queue as UpdateQueue
 
 from dotenv import load_dotenv
-from telegram import Update
-from telegram.ext import (Updater, CommandHandler, MessageHandler,
-                          ConversationHandler, CallbackContext, Filters, CallbackQueryHandler)
+from telegram import Update, Bot
+from telegram.ext import (Updater, CommandHandler, MessageHandler, ConversationHandler,
+                          CallbackContext, Filters, CallbackQueryHandler, Dispatcher)
 
-from src.db.db_session import global_init, create_session
-from src.db.models.queue import Queue
-from src.db.models.state import State
-from src.menu import menu, ask_surname, finish_registration, ask_name
+from src.archive import archiver
+from src.cache import user_cache_hit_rate
+from src.cluster import cluster
+from src.constants import BROADCAST_WORKERS, LANE_WORKERS
+from src.db.db_session import global_init, get_engine
+from src.export import QueueExport
+from src.lanes import LaneDispatcher
+from src.live import live_views
+from src.menu import menu, ask_surname, finish_registration, ask_name, settings, set_subscription
+from src.metrics import metrics, InstrumentedRequest, instrument_engine, instrument_conversation
+from src.outbox import outbox
+from src.persistence import DBPersistence
 from src.queue import QueueView, QueueAdd, notify_queue, open_queue, close_queue
-
-
-def load_states(updater: Updater, conv_handler: ConversationHandler):
-    with create_session() as session:
-        for state in session.query(State).all():
-            conv_handler._conversations[(state.user_id, state.user_id)] = state.callback
-            user_data = json.loads(state.data)
-            updater.dispatcher.user_data[state.user_id] = user_data
-            context = CallbackContext(updater.dispatcher)
-            context._bot = updater.bot
-            for job in updater.dispatcher.job_queue.get_jobs_by_name('process'):
-                job.schedule_removal()
-
-
-def start_jobs(dispatcher, bot):
-    context = CallbackContext(dispatcher)
-    context._bot = bot
-    with create_session() as session:
-        for q in session.query(Queue).filter(Queue.status != 'archived').all():
-            if q.status == 'planned':
-                if not q.notification_sent:
-                    secs = (q.notify_dt - datetime.utcnow() - timedelta(hours=3)).total_seconds()
-                    context.job_queue.run_once(
-                        notify_queue, secs if secs >= 0 else 0,
-                        context=context, name=str(q.id))
-                secs = (q.start_dt - datetime.utcnow() - timedelta(hours=3)).total_seconds()
-                context.job_queue.run_once(
-                    open_queue, secs if secs >= 0 else 0,
-                    context=context, name=str(q.id))
-            secs = (q.end_dt - datetime.utcnow() - timedelta(hours=3)).total_seconds()
-            context.job_queue.run_once(
-                close_queue, secs if secs >= 0 else 0,
-                context=context, name=str(q.id))
+from src.queue_import import QueueImport
+from src.registration import pipeline
+from src.scheduler import scheduler
+from src.webhook import WebhookServer
 
 
 def register_by_name(update: Update, context: CallbackContext):
     if not update.message.text:
         return context.bot.send_message(context.user_data['id'], 'Сообщение пустое')
-    context.user_data['queue_name'] = update.message.text
-    return QueueView.register(update, context)
+    return QueueView.search(update, context)
 
 
-def main():
-    updater = Updater(os.getenv('token'))
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', menu)],
+def build_conversation_handler() -> ConversationHandler:
+    return ConversationHandler(
+        # Entry points are matched before the text handlers of the current state
+        entry_points=[CommandHandler('start', menu),
+                      CommandHandler('import', QueueImport.ask_file),
+                      CommandHandler('export', QueueExport.command)],
         allow_reentry=True,
+        name='main',
+        persistent=True,
         states={
             'menu': [CallbackQueryHandler(QueueView.show_all, pattern='(active)|(planned)|(archived)'),
                      CallbackQueryHandler(QueueAdd.ask_name, pattern='add_queue'),
+                     CallbackQueryHandler(QueueImport.ask_file, pattern='import_queues'),
+                     CallbackQueryHandler(settings, pattern='settings'),
                      MessageHandler(Filters.text, register_by_name)],
+            'search': [CallbackQueryHandler(QueueView.register, pattern='reg [0-9]+'),
+                       CallbackQueryHandler(QueueView.show, pattern='show [0-9]+'),
+                       CallbackQueryHandler(menu, pattern='back'),
+                       MessageHandler(Filters.text, register_by_name)],
             'ask_name': [MessageHandler(Filters.text, ask_surname),
                          CallbackQueryHandler(menu, pattern='back')],
             'ask_surname': [MessageHandler(Filters.text, finish_registration),
@@ -75,6 +63,11 @@ def main():
                        CallbackQueryHandler(menu, pattern='back')],
             'queue': [CallbackQueryHandler(QueueView.register, pattern='[0-9]+'),
                       CallbackQueryHandler(QueueView.show, pattern='refresh [0-9]+'),
+                      CallbackQueryHandler(QueueView.leave, pattern='leave [0-9]+'),
+                      CallbackQueryHandler(QueueView.swap, pattern='swap [0-9]+'),
+                      CallbackQueryHandler(QueueView.advance, pattern='next [0-9]+'),
+                      CallbackQueryHandler(QueueView.show, pattern='page [0-9]+ [0-9]+'),
+                      CallbackQueryHandler(QueueExport.queue, pattern='export [0-9]+'),
                       CallbackQueryHandler(QueueView.show_all, pattern='back')],
             'QueueAdd.ask_name': [MessageHandler(Filters.text, QueueAdd.ask_start_dt),
                                   CallbackQueryHandler(menu, pattern='back')],
@@ -84,14 +77,76 @@ def main():
                                     CallbackQueryHandler(QueueAdd.ask_start_dt, pattern='back')],
             'QueueAdd.ask_notify_dt': [MessageHandler(Filters.text, QueueAdd.finish),
                                        CallbackQueryHandler(QueueAdd.ask_end_dt, pattern='back')],
+            'settings': [CallbackQueryHandler(set_subscription, pattern='sub [a-z]+'),
+                         CallbackQueryHandler(menu, pattern='back')],
+            'QueueImport.ask_file': [MessageHandler(Filters.document, QueueImport.finish),
+                                     CallbackQueryHandler(menu, pattern='back')],
         },
         fallbacks=[CommandHandler('start', menu),
                    CallbackQueryHandler(QueueView.register, pattern='reg [0-9]+')])
-    updater.dispatcher.add_handler(conv_handler)
-    load_states(updater, conv_handler)
-    start_jobs(updater.dispatcher, updater.bot)
-    updater.start_polling()
-    updater.idle()
+
+
+def main():
+    persistence = DBPersistence(lazy=os.getenv('lazy_states', '1') != '0')
+    workers = 4
+    lane_workers = int(os.getenv('update_workers', LANE_WORKERS))
+    # Broadcasts, the scheduler and live updates share the bot with the dispatcher workers
+    request = InstrumentedRequest(con_pool_size=workers + lane_workers + 4 + BROADCAST_WORKERS)
+    bot = Bot(os.getenv('token'), request=request)
+    if lane_workers:
+        dispatcher = LaneDispatcher(bot, UpdateQueue(), workers=workers, persistence=persistence,
+                                    lane_workers=lane_workers)
+    else:
+        dispatcher = Dispatcher(bot, UpdateQueue(), workers=workers, persistence=persistence)
+    updater = Updater(dispatcher=dispatcher)
+    updater.dispatcher.add_handler(instrument_conversation(build_conversation_handler()))
+    instrument_engine(get_engine())
+    metrics.gauge('update_queue_size', lambda: updater.dispatcher.update_queue.qsize())
+    metrics.gauge('user_cache_hit_rate', user_cache_hit_rate)
+    metrics.gauge('registration_p99_seconds', lambda: pipeline.percentile(99))
+    metrics.start(int(os.getenv('metrics_port', 0)), os.getenv('metrics_file'),
+                  os.getenv('metrics_host', '0.0.0.0'))
+    persistence.start()
+    live_views.start(updater.bot, updater.dispatcher)
+    if os.getenv('archive_after_days'):
+        archiver.age = timedelta(days=float(os.getenv('archive_after_days')))
+    jobs = {event: metrics.timed(handler, event, 'job') for event, handler in (
+        ('notify', notify_queue), ('open', open_queue), ('close', close_queue))}
+
+    def lead():
+        outbox.start(updater.bot)
+        archiver.start()
+        scheduler.start(updater.bot, jobs)
+
+    def step_down():
+        scheduler.stop()
+        archiver.stop()
+        outbox.stop()
+
+    worker_count = int(os.getenv('worker_count', 1))
+    webhook = os.getenv('updates_mode', 'polling') == 'webhook'
+    if worker_count > 1 and not webhook:
+        raise ValueError('Multi-worker mode needs updates_mode=webhook')
+    if webhook and not os.getenv('webhook_secret'):
+        raise ValueError('Webhook mode needs webhook_secret')
+    # Only the worker holding the leader lock runs transitions and archiving
+    cluster.start(get_engine(), lead, step_down, int(os.getenv('worker_index', 0)), worker_count,
+                  [peer for peer in os.getenv('worker_peers', '').split(',') if peer])
+    if webhook:
+        server = WebhookServer(updater.dispatcher, os.getenv('webhook_host', '0.0.0.0'),
+                               int(os.getenv('webhook_port', os.getenv('PORT', 8443))),
+                               os.getenv('webhook_path', 'telegram'), os.getenv('webhook_secret'),
+                               cluster=cluster)
+        server.start(os.getenv('webhook_url'))
+        server.idle()
+    else:
+        updater.start_polling()
+        updater.idle()
+    cluster.stop()
+    live_views.stop()
+    pipeline.stop()
+    persistence.stop()
+    metrics.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,100 @@
+import json
+from datetime import timedelta
+from threading import Thread, Event
+
+from src.cache import bump_queue_version, invalidate_status_counts
+from src.constants import ARCHIVE_AFTER, ARCHIVE_INTERVAL, ARCHIVE_BATCH, ARCHIVE_PAUSE
+from src.db.db_session import create_session, read_session
+from src.db.models.archived_queue import ArchivedQueue
+from src.db.models.attendant import Attendant
+from src.db.models.queue import Queue
+from src.db.models.user import User
+from src.metrics import metrics
+from src.utils import local_now
+
+
+def compact_queue(queue_id: int) -> bool:
+    # One small transaction per queue: only this queue's rows are locked, and only briefly
+    with create_session() as session:
+        queue = session.query(Queue).filter(
+            (Queue.id == queue_id) & (Queue.status == 'archived')).with_for_update(
+            skip_locked=True).first()
+        if not queue:
+            return False
+        rows = session.query(Attendant.user_id, User.name, User.surname, Attendant.served_dt).join(
+            User, User.id == Attendant.user_id).filter(
+            Attendant.queue_id == queue_id).order_by(Attendant.position).all()
+        session.add(ArchivedQueue(id=queue.id, name=queue.name, start_dt=queue.start_dt,
+                                  end_dt=queue.end_dt, notify_dt=queue.notify_dt,
+                                  archived_dt=local_now(), attendants_count=len(rows),
+                                  attendants=json.dumps(
+                                      [[user_id, name, surname,
+                                        served_dt.isoformat() if served_dt else None]
+                                       for user_id, name, surname, served_dt in rows],
+                                      ensure_ascii=False)))
+        session.query(Attendant).filter(Attendant.queue_id == queue_id).delete(
+            synchronize_session=False)
+        session.query(Queue).filter(Queue.id == queue_id).delete(synchronize_session=False)
+        session.commit()
+    bump_queue_version(queue_id)
+    return True
+
+
+class Archiver:
+    def __init__(self, age: timedelta = ARCHIVE_AFTER, interval: float = ARCHIVE_INTERVAL,
+                 batch_size: int = ARCHIVE_BATCH, pause: float = ARCHIVE_PAUSE):
+        self.age = age
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='archiver', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self) -> int:
+        compacted = 0
+        while not self._stop.is_set():
+            with read_session() as session:
+                queue_ids = [row.id for row in session.query(Queue.id).filter(
+                    (Queue.status == 'archived') & (Queue.end_dt < local_now() - self.age)).order_by(
+                    Queue.id).limit(self.batch_size)]
+            batch = 0
+            for queue_id in queue_ids:
+                if self._stop.is_set():
+                    break
+                try:
+                    batch += compact_queue(queue_id)
+                except Exception as e:
+                    print(f'[archiver] Compacting {queue_id=} failed: {e}')
+                self._stop.wait(self.pause)
+            if batch:
+                invalidate_status_counts()
+                metrics.inc('archived_queues_total', batch)
+            compacted += batch
+            if not batch or len(queue_ids) < self.batch_size:
+                break
+        if compacted:
+            print(f'[archiver] Compacted {compacted} queues')
+        return compacted
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f'[archiver] {e}')
+            self._stop.wait(self.interval)
+
+
+archiver = Archiver()
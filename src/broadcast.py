@@ -0,0 +1,129 @@
+import time
+from queue import Queue as TaskQueue
+from threading import Thread, Lock
+
+from telegram.error import RetryAfter, Unauthorized, BadRequest, TimedOut, NetworkError
+
+from src.constants import (BROADCAST_WORKERS, BROADCAST_RATE, BROADCAST_CHAT_INTERVAL,
+                           BROADCAST_MAX_RETRIES)
+from src.metrics import metrics
+
+
+class RateLimiter:
+    def __init__(self, rate: float, chat_interval: float):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self._lock = Lock()
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next = {}
+
+    def acquire(self, chat_id):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                wait = max(self._paused_until - now, self._chat_next.get(chat_id, 0) - now)
+                if wait <= 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    self._chat_next[chat_id] = now + self.chat_interval
+                    if len(self._chat_next) > 10000:
+                        self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+                    return
+                if wait <= 0:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        # Telegram answers with RetryAfter on the bot level, so everyone has to wait
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+limiter = RateLimiter(BROADCAST_RATE, BROADCAST_CHAT_INTERVAL)
+
+
+class BroadcastStats:
+    def __init__(self):
+        self._lock = Lock()
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def add(self, attr: str):
+        with self._lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f'sent={self.sent} blocked={self.blocked} failed={self.failed} '
+                f'retries={self.retries} elapsed={self.elapsed:.1f}s '
+                f'throughput={self.throughput:.1f} msg/s')
+
+
+def _send(bot, chat_id, text: str, kwargs: dict, stats: BroadcastStats):
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        limiter.acquire(chat_id)
+        try:
+            bot.send_message(chat_id, text, **kwargs)
+            stats.add('sent')
+            return None
+        except RetryAfter as e:
+            limiter.pause(e.retry_after)
+            error = e
+        except (Unauthorized, BadRequest) as e:
+            stats.add('blocked')
+            return e
+        except (TimedOut, NetworkError) as e:
+            time.sleep(2 ** attempt)
+            error = e
+        stats.add('retries')
+    stats.add('failed')
+    return error
+
+
+def broadcast(bot, chat_ids, text: str, on_result=None, tag: str = 'broadcast',
+              workers: int = BROADCAST_WORKERS, **kwargs) -> BroadcastStats:
+    stats = BroadcastStats()
+    tasks = TaskQueue(maxsize=workers * 4)
+
+    def worker():
+        while True:
+            chat_id = tasks.get()
+            if chat_id is None:
+                return
+            try:
+                error = _send(bot, chat_id, text, kwargs, stats)
+            except Exception as e:
+                stats.add('failed')
+                error = e
+            if error is not None:
+                print(f'[{tag}] {chat_id=}: {error}')
+            if on_result is not None:
+                try:
+                    on_result(chat_id, error)
+                except Exception as e:
+                    print(f'[{tag}] on_result failed on {chat_id=}: {e}')
+
+    threads = [Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for chat_id in chat_ids:
+        tasks.put(chat_id)
+    for _ in threads:
+        tasks.put(None)
+    for thread in threads:
+        thread.join()
+    stats.elapsed = time.monotonic() - stats.started
+    for result in ('sent', 'blocked', 'failed', 'retries'):
+        metrics.inc('broadcast_messages_total', getattr(stats, result), tag=tag, result=result)
+    print(f'[{tag}] {stats}')
+    return stats
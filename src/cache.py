@@ -0,0 +1,159 @@
+import json
+from collections import namedtuple, OrderedDict
+from threading import Lock
+
+from sqlalchemy import func
+
+from src.constants import QUEUE_CARD_CACHE_SIZE, USER_CACHE_SIZE
+from src.db.db_session import read_session
+from src.db.models.archived_queue import ArchivedQueue
+from src.db.models.attendant import Attendant
+from src.db.models.queue import Queue
+from src.db.models.user import User
+from src.utils import format_queue_info
+
+QueueCard = namedtuple('QueueCard', 'queue_id version status header attendants user_ids')
+CachedUser = namedtuple('CachedUser', 'id name surname is_admin reachable subscription')
+AttendantRow = namedtuple('AttendantRow', 'user_id name surname served_dt', defaults=(None,))
+
+_lock = Lock()
+_status_counts = None
+_status_generation = 0
+_queue_versions = {}
+_queue_cards = OrderedDict()
+_version_listeners = []
+_status_listeners = []
+_user_listeners = []
+_users = OrderedDict()
+_users_generation = 0
+user_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def get_status_counts() -> dict:
+    global _status_counts
+    counts = _status_counts
+    if counts is not None:
+        return counts
+    generation = _status_generation
+    with read_session() as session:
+        counts = dict(session.query(Queue.status, func.count(Queue.id)).group_by(Queue.status))
+        compacted = session.query(func.count(ArchivedQueue.id)).scalar()
+    if compacted:
+        counts['archived'] = counts.get('archived', 0) + compacted
+    with _lock:
+        # A transition that happened while we were counting makes this result stale
+        if generation == _status_generation:
+            _status_counts = counts
+    return counts
+
+
+def invalidate_status_counts():
+    global _status_counts, _status_generation
+    with _lock:
+        _status_counts = None
+        _status_generation += 1
+    for listener in _status_listeners:
+        listener()
+
+
+def add_status_listener(listener):
+    _status_listeners.append(listener)
+
+
+def add_version_listener(listener):
+    _version_listeners.append(listener)
+
+
+def add_user_listener(listener):
+    _user_listeners.append(listener)
+
+
+def clear_queue_cards():
+    with _lock:
+        for queue_id in _queue_cards:
+            _queue_versions[queue_id] = _queue_versions.get(queue_id, 0) + 1
+        _queue_cards.clear()
+
+
+def bump_queue_version(queue_id: int):
+    with _lock:
+        _queue_versions[queue_id] = _queue_versions.get(queue_id, 0) + 1
+        _queue_cards.pop(queue_id, None)
+    for listener in _version_listeners:
+        listener(queue_id)
+
+
+def get_queue_card(queue_id: int):
+    version = _queue_versions.get(queue_id, 0)
+    card = _queue_cards.get(queue_id)
+    if card is not None and card.version == version:
+        with _lock:
+            if queue_id in _queue_cards:
+                _queue_cards.move_to_end(queue_id)
+        return card
+    with read_session() as session:
+        queue = session.query(Queue).get(queue_id)
+        if queue:
+            rows = session.query(Attendant.user_id, User.name, User.surname,
+                                 Attendant.served_dt).join(
+                User, User.id == Attendant.user_id).filter(
+                Attendant.queue_id == queue_id).order_by(Attendant.position).all()
+        else:
+            queue = session.query(ArchivedQueue).get(queue_id)
+            if not queue:
+                return None
+            rows = [AttendantRow(*row) for row in json.loads(queue.attendants)]
+        # Positions are sparse sort keys, ordinals are only assigned when rendering
+        card = QueueCard(queue_id, version, queue.status, format_queue_info(queue),
+                         [(row.user_id, f'{row.name} {row.surname}', row.served_dt is not None)
+                          for row in rows],
+                         frozenset(row.user_id for row in rows))
+    with _lock:
+        if _queue_versions.get(queue_id, 0) == version:
+            _queue_cards[queue_id] = card
+            _queue_cards.move_to_end(queue_id)
+            while len(_queue_cards) > QUEUE_CARD_CACHE_SIZE:
+                _queue_cards.popitem(last=False)
+    return card
+
+
+def get_user(user_id):
+    user_id = str(user_id)
+    with _lock:
+        if user_id in _users:
+            _users.move_to_end(user_id)
+            user_cache_stats['hits'] += 1
+            return _users[user_id]
+        user_cache_stats['misses'] += 1
+        generation = _users_generation
+    with read_session() as session:
+        user = session.query(User).get(user_id)
+        cached = CachedUser(user.id, user.name, user.surname, user.is_admin,
+                            user.reachable is not False, user.subscription or 'all') if user else None
+    with _lock:
+        if generation == _users_generation:
+            _users[user_id] = cached
+            while len(_users) > USER_CACHE_SIZE:
+                _users.popitem(last=False)
+    return cached
+
+
+def invalidate_user(user_id):
+    global _users_generation
+    with _lock:
+        _users.pop(str(user_id), None)
+        _users_generation += 1
+    for listener in _user_listeners:
+        listener(user_id)
+
+
+def clear_users():
+    global _users_generation
+    with _lock:
+        _users.clear()
+        _users_generation += 1
+
+
+def user_cache_hit_rate() -> float:
+    total = user_cache_stats['hits'] + user_cache_stats['misses']
+    return user_cache_stats['hits'] / total if total else 0.0
@@ -0,0 +1,184 @@
+import select
+import urllib.error
+import urllib.request
+from threading import Thread, Event, local
+
+from sqlalchemy import text
+
+from src.cache import (add_version_listener, add_status_listener, add_user_listener,
+                       bump_queue_version, invalidate_status_counts, invalidate_user,
+                       clear_queue_cards, clear_users)
+from src.constants import LEADER_LOCK_ID, LEADER_CHECK_INTERVAL, CLUSTER_CHANNEL, FORWARD_TIMEOUT
+from src.lanes import LaneDispatcher
+from src.metrics import metrics
+from src.scheduler import scheduler
+
+FORWARDED_HEADER = 'X-Queue-Bot-Forwarded'
+
+
+class Cluster:
+    def __init__(self):
+        self.worker_index = 0
+        self.worker_count = 1
+        self.peers = []
+        self.engine = None
+        self.is_leader = False
+        self._on_elected = None
+        self._on_demoted = None
+        self._remote = local()
+        self._stop = Event()
+        self._threads = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.worker_count > 1
+
+    def start(self, engine, on_elected, on_demoted, worker_index: int = 0, worker_count: int = 1,
+              peers: list = ()):
+        self.engine = engine
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.peers = [peer.rstrip('/') for peer in peers]
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        metrics.gauge('cluster_leader', lambda: int(self.is_leader))
+        if not self.enabled:
+            self._elect()
+            return
+        if engine.dialect.name != 'postgresql':
+            raise ValueError('Multi-worker mode needs Postgres')
+        if len(self.peers) != worker_count:
+            raise ValueError(f'Expected {worker_count} worker_peers, got {len(self.peers)}')
+        add_version_listener(lambda queue_id: self._publish('queue', queue_id))
+        add_status_listener(lambda: self._publish('status', ''))
+        add_user_listener(lambda user_id: self._publish('user', user_id))
+        self._stop.clear()
+        self._threads = [Thread(target=self._lead, name='cluster_leader', daemon=True),
+                         Thread(target=self._listen, name='cluster_listener', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._demote()
+
+    def _elect(self):
+        self.is_leader = True
+        print(f'[cluster] Worker {self.worker_index} leads the scheduled jobs')
+        self._on_elected()
+
+    def _demote(self):
+        if self.is_leader:
+            self.is_leader = False
+            self._on_demoted()
+
+    def _lead(self):
+        # The lock belongs to the database session, so it goes away with a crashed worker and
+        # another one takes over on its next attempt
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+                while not self._stop.is_set():
+                    if self.is_leader:
+                        conn.execute(text('SELECT 1'))
+                    elif conn.execute(text('SELECT pg_try_advisory_lock(:id)'),
+                                      {'id': LEADER_LOCK_ID}).scalar():
+                        self._elect()
+                    self._stop.wait(LEADER_CHECK_INTERVAL)
+            except Exception as e:
+                print(f'[cluster] Leader connection failed: {e}')
+            finally:
+                # Jobs stop before the lock is released, so two leaders never overlap
+                self._demote()
+                if conn is not None:
+                    # Never hand a session holding the lock back to the pool
+                    conn.invalidate()
+                    conn.close()
+            self._stop.wait(LEADER_CHECK_INTERVAL)
+
+    def _publish(self, kind: str, value):
+        if getattr(self._remote, 'active', False):
+            return
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text('SELECT pg_notify(:channel, :payload)'),
+                             {'channel': CLUSTER_CHANNEL,
+                              'payload': f'{self.worker_index}:{kind}:{value}'})
+        except Exception as e:
+            print(f'[cluster] Publishing {kind} {value} failed: {e}')
+
+    def _receive(self, payload: str):
+        worker_index, kind, value = payload.split(':', 2)
+        if int(worker_index) == self.worker_index:
+            return
+        # Changes made by other workers invalidate local caches without being sent back out
+        self._remote.active = True
+        try:
+            if kind == 'queue':
+                bump_queue_version(int(value))
+            elif kind == 'status':
+                invalidate_status_counts()
+                scheduler.wake()
+            elif kind == 'user':
+                invalidate_user(value)
+        finally:
+            self._remote.active = False
+
+    def _listen(self):
+        while not self._stop.is_set():
+            raw = None
+            try:
+                raw = self.engine.raw_connection()
+                connection = raw.connection
+                connection.autocommit = True
+                connection.cursor().execute(f'LISTEN {CLUSTER_CHANNEL}')
+                # Anything published while we were not listening is lost, so start from scratch
+                self._remote.active = True
+                try:
+                    invalidate_status_counts()
+                    clear_queue_cards()
+                    clear_users()
+                finally:
+                    self._remote.active = False
+                while not self._stop.is_set():
+                    if not select.select([connection], [], [], LEADER_CHECK_INTERVAL)[0]:
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self._receive(connection.notifies.pop(0).payload)
+            except Exception as e:
+                print(f'[cluster] Listener failed: {e}')
+                self._stop.wait(LEADER_CHECK_INTERVAL)
+            finally:
+                if raw is not None:
+                    raw.invalidate()
+
+    def owner(self, update) -> int:
+        key = LaneDispatcher.lane_key(update)
+        if not self.enabled or key is None:
+            return self.worker_index
+        return int(key) % self.worker_count
+
+    def forward(self, worker_index: int, body: bytes, path: str, secret: str = None) -> int:
+        headers = {'Content-Type': 'application/json', FORWARDED_HEADER: str(self.worker_index)}
+        if secret:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+        request = urllib.request.Request(self.peers[worker_index] + path, body, headers)
+        try:
+            with urllib.request.urlopen(request, timeout=FORWARD_TIMEOUT) as response:
+                code = response.status
+        except urllib.error.HTTPError as e:
+            code = e.code
+        except OSError as e:
+            print(f'[cluster] Forwarding to worker {worker_index} failed: {e}')
+            # Telegram delivers the update again later
+            code = 503
+        metrics.inc('forwarded_updates_total', worker=worker_index, code=code)
+        return code
+
+
+cluster = Cluster()
@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 PAGINATION_STEP = 10
 STATUS_VERBOSES = {
     'active': 'активных',
@@ -15,4 +17,58 @@ VIEW_STATUS_VERBOSES = {
     'archived': 'Архивирована'
 }
 MIN_DELTA = 5  # 300
-MIN_DUR = 120  # 1200
\ No newline at end of file
+MIN_DUR = 120  # 1200
+BROADCAST_WORKERS = 8
+BROADCAST_RATE = 25  # messages per second, Telegram allows ~30
+BROADCAST_CHAT_INTERVAL = 1  # seconds between messages to the same chat
+BROADCAST_MAX_RETRIES = 3
+REGISTRATION_BATCH_INTERVAL = 0.005  # seconds a batch waits for more registrations
+REGISTRATION_MAX_BATCH = 200
+REGISTRATION_TIMEOUT = 10
+QUEUE_CARD_CACHE_SIZE = 256
+PERSISTENCE_FLUSH_INTERVAL = 5
+PERSISTENCE_MAX_RESIDENT = 2000  # idle users kept in memory in lazy mode
+PERSISTENCE_BUSY_TIMEOUT = 60  # seconds a user stays pinned when an update never hands its data back
+TZ_OFFSET = timedelta(hours=3)  # queue times are entered and stored in Moscow time
+SCHEDULER_POLL_INTERVAL = 30  # longest sleep, so edited times are picked up without a wake-up
+SCHEDULER_BATCH = 50
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_PUT_TIMEOUT = 5
+LIVE_UPDATE_INTERVAL = 5  # seconds between pushed edits of a queue card in one chat
+LIVE_VIEW_TTL = 900
+USER_CACHE_SIZE = 5000
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # seconds
+METRICS_FILE_INTERVAL = 15
+MESSAGE_LIMIT = 4096
+QUEUE_IMPORT_MAX_SIZE = 512 * 1024  # bytes
+QUEUE_IMPORT_MAX_ROWS = 500
+QUEUE_IMPORT_NOTIFY_BEFORE = timedelta(hours=1)  # for calendar events without an alarm
+POSITION_GAP = 1024  # attendant positions are spaced out so rows can be moved without renumbering
+QUEUE_NOTIFY_AHEAD = 3  # users told that their turn is approaching when the head advances
+ARCHIVE_AFTER = timedelta(days=30)  # how long closed queues stay in the live tables
+ARCHIVE_INTERVAL = 3600
+ARCHIVE_BATCH = 20
+ARCHIVE_PAUSE = 0.1  # seconds between compacted queues, so live traffic gets the database
+LANE_WORKERS = 8  # threads handling updates of different users in parallel
+LEADER_LOCK_ID = 4232  # Postgres advisory lock held by the worker that runs the scheduler
+LEADER_CHECK_INTERVAL = 5
+CLUSTER_CHANNEL = 'queue_bot'
+FORWARD_TIMEOUT = 10
+OUTBOX_BATCH = 200  # deliveries sent between two progress commits
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_POLL_INTERVAL = 30
+DELIVERY_EVENT_VERBOSES = {
+    'notify': 'оповещение',
+    'open': 'открытие',
+    'close': 'закрытие'
+}
+DEAD_CHAT_FAILURES = 3  # failed deliveries in a row after which a chat is skipped
+SUBSCRIPTION_VERBOSES = {
+    'all': 'Все очереди',
+    'closing': 'Только о закрытии моих очередей',
+    'mute': 'Без рассылок'
+}
+SEARCH_LIMIT = 8  # suggestions offered for a queue name that does not match exactly
+EXPORT_FETCH = 500  # rows fetched from the server-side cursor at a time
+EXPORT_SPOOL_SIZE = 1024 * 1024  # bytes of CSV kept in memory before spilling to disk
+EXPORT_PART_SIZE = 48 * 1024 * 1024  # bytes per exported document, Telegram takes up to 50 MB
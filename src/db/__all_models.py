@@ -1,3 +1,7 @@
 from src.db.models.user import User
 from src.db.models.attendant import Attendant
 from src.db.models.queue import Queue
+from src.db.models.schema_version import SchemaVersion
+from src.db.models.state import State
+from src.db.models.archived_queue import ArchivedQueue
+from src.db.models.outbox import OutboxMessage, Delivery
@@ -1,27 +1,78 @@
+import os
+from contextlib import contextmanager
+from threading import local
+
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
 from sqlalchemy.ext.declarative import declarative_base
 
 SQLAlchemyBase = declarative_base()
 
+__engine = None
 __factory = None
+__read_registry = None
+__read_depth = local()
+
+
+class ReadOnlySession(Session):
+    def flush(self, objects=None):
+        pass
+
+
+def _engine_kwargs(url: str) -> dict:
+    kwargs = {'echo': False, 'pool_pre_ping': os.getenv('db_pool_pre_ping', '1') != '0'}
+    if url.startswith('sqlite'):
+        return kwargs
+    kwargs.update(pool_size=int(os.getenv('db_pool_size', 10)),
+                  max_overflow=int(os.getenv('db_max_overflow', 20)),
+                  pool_timeout=int(os.getenv('db_pool_timeout', 30)),
+                  pool_recycle=int(os.getenv('db_pool_recycle', 1800)))
+    statement_timeout = os.getenv('db_statement_timeout')
+    if statement_timeout and url.startswith('postgresql'):
+        kwargs['connect_args'] = {'options': f'-c statement_timeout={int(statement_timeout)}'}
+    return kwargs
 
 
 def global_init(db_file):
-    global __factory
+    global __engine, __factory, __read_registry
     if __factory:
         return None
     db_file = db_file.strip()
     if not db_file:
         raise Exception('Необходимо указать файл данных')
-    engine = create_engine(db_file.replace('postgres', 'postgresql'), echo=False)
+    url = db_file.replace('postgres://', 'postgresql://')
+    engine = create_engine(url, **_engine_kwargs(url))
+    __engine = engine
     __factory = sessionmaker(bind=engine)
+    __read_registry = scoped_session(sessionmaker(
+        bind=engine, class_=ReadOnlySession, autoflush=False, expire_on_commit=False))
 
     from . import __all_models
 
     SQLAlchemyBase.metadata.create_all(engine)
 
+    from .migrations import migrate
+
+    migrate(engine)
+
+
+def get_engine():
+    return __engine
+
 
 def create_session() -> Session:
     global __factory
-    return __factory()
\ No newline at end of file
+    return __factory()
+
+
+@contextmanager
+def read_session() -> Session:
+    # Thread-scoped: nested read_session() calls share one session, the outermost one cleans up
+    depth = getattr(__read_depth, 'value', 0)
+    __read_depth.value = depth + 1
+    try:
+        yield __read_registry()
+    finally:
+        __read_depth.value = depth
+        if not depth:
+            __read_registry.remove()
@@ -0,0 +1,200 @@
+from datetime import datetime
+
+from sqlalchemy import text, inspect
+from sqlalchemy.schema import CreateTable
+
+from src.db.models.schema_version import SchemaVersion
+
+
+def add_column(table: str, column: str, ddl: str):
+    # create_all already makes the column on a fresh database, so only add it when missing
+    def fix(conn):
+        if column not in {c['name'] for c in inspect(conn).get_columns(table)}:
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+    return fix
+
+
+def create_extension(name: str):
+    # Extensions need extra privileges, so indexes that use one are skipped when it is missing
+    def fix(conn):
+        if conn.dialect.name != 'postgresql' or not conn.execute(text(
+                'SELECT 1 FROM pg_available_extensions WHERE name = :name'), {'name': name}).first():
+            return
+        try:
+            with conn.begin_nested():
+                conn.execute(text(f'CREATE EXTENSION IF NOT EXISTS {name}'))
+        except Exception as e:
+            print(f'[migrate] Extension {name} is not available: {e}')
+
+    return fix
+
+
+def never_reuse_queue_ids(conn):
+    # Postgres sequences never go back. SQLite without AUTOINCREMENT hands out the highest freed
+    # id again, so the table is rebuilt with it and the counter is moved past the archived ids.
+    if conn.dialect.name != 'sqlite':
+        return
+    from src.db.models.queue import Queue
+
+    ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND "
+                            "name = 'queues'")).scalar()
+    if 'AUTOINCREMENT' not in ddl.upper():
+        # Renaming the old table would repoint the attendants' foreign key, so the new one is
+        # built aside and renamed into place
+        columns = ', '.join(column.name for column in Queue.__table__.columns)
+        create = str(CreateTable(Queue.__table__).compile(dialect=conn.dialect))
+        conn.execute(text(create.replace('CREATE TABLE queues', 'CREATE TABLE queues_new', 1)))
+        conn.execute(text(f'INSERT INTO queues_new ({columns}) SELECT {columns} FROM queues'))
+        conn.execute(text('DROP TABLE queues'))
+        conn.execute(text('ALTER TABLE queues_new RENAME TO queues'))
+        for index in Queue.__table__.indexes:
+            index.create(conn)
+    top = conn.execute(text('SELECT max(coalesce((SELECT max(id) FROM queues), 0), '
+                            'coalesce((SELECT max(id) FROM archived_queues), 0))')).scalar()
+    if not conn.execute(text("SELECT 1 FROM sqlite_sequence WHERE name = 'queues'")).first():
+        conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('queues', 0)"))
+    conn.execute(text("UPDATE sqlite_sequence SET seq = max(seq, :top) WHERE name = 'queues'"),
+                 {'top': top})
+
+
+def on_postgres(conn) -> bool:
+    return conn.dialect.name == 'postgresql'
+
+
+def has_extension(name: str):
+    def check(conn):
+        return on_postgres(conn) and bool(conn.execute(text(
+            'SELECT 1 FROM pg_extension WHERE extname = :name'), {'name': name}).first())
+
+    return check
+
+
+# Every step is (version, description, data fixes, new indexes, dropped indexes). Data fixes are
+# SQL statements or callables taking the connection and run in one transaction, indexes are
+# built and dropped one by one and, on Postgres, CONCURRENTLY so live tables stay writable.
+# An index may carry a fourth element, a check taking the connection, and is skipped when it fails.
+MIGRATIONS = [
+    (1, 'Indexes for the hot query paths', [
+        'DELETE FROM attendants WHERE id NOT IN '
+        '(SELECT min(id) FROM attendants GROUP BY queue_id, user_id)',
+        'UPDATE attendants SET position = '
+        '(SELECT count(*) FROM attendants a2 WHERE a2.queue_id = attendants.queue_id AND '
+        '(a2.position < attendants.position OR '
+        '(a2.position = attendants.position AND a2.id <= attendants.id))) '
+        'WHERE queue_id IN (SELECT queue_id FROM attendants '
+        'GROUP BY queue_id, position HAVING count(*) > 1)',
+    ], [
+        ('ix_queues_status', 'queues (status)', False),
+        ('ix_queues_lower_name', 'queues (lower(name))', False),
+        ('ux_attendants_queue_user', 'attendants (queue_id, user_id)', True),
+        ('ux_attendants_queue_position', 'attendants (queue_id, position)', True),
+        ('ix_attendants_user_id', 'attendants (user_id)', False),
+        ('ix_users_name_surname', 'users (name, surname)', False),
+    ], []),
+    (2, 'Status index covering the pagination order', [], [
+        ('ix_queues_status_id', 'queues (status, id)', False),
+    ], ['ix_queues_status']),
+    (3, 'Indexes for the transition scheduler', [], [
+        ('ix_queues_status_notify_dt', 'queues (status, notify_dt)', False),
+        ('ix_queues_status_start_dt', 'queues (status, start_dt)', False),
+        ('ix_queues_status_end_dt', 'queues (status, end_dt)', False),
+    ], []),
+    # 1024 is POSITION_GAP at the time of the migration. Going through negative values keeps
+    # (queue_id, position) unique after every row update.
+    (4, 'Sparse attendant positions', [
+        'UPDATE attendants SET position = -position * 1024',
+        'UPDATE attendants SET position = -position',
+    ], [], []),
+    (5, 'Delivery health and broadcast subscriptions of users', [
+        add_column('users', 'reachable', 'BOOLEAN NOT NULL DEFAULT TRUE'),
+        add_column('users', 'failed_deliveries', 'INTEGER NOT NULL DEFAULT 0'),
+        add_column('users', 'subscription', "VARCHAR NOT NULL DEFAULT 'all'"),
+    ], [], []),
+    # Operator classes are Postgres only, SQLite searches an in-memory index instead
+    (6, 'Prefix and trigram indexes for queue search', [
+        create_extension('pg_trgm'),
+    ], [
+        ('ix_queues_name_pattern', 'queues (lower(name) text_pattern_ops)', False, on_postgres),
+        ('ix_archived_queues_name_pattern', 'archived_queues (lower(name) text_pattern_ops)', False,
+         on_postgres),
+        ('ix_queues_name_trgm', 'queues USING gin (lower(name) gin_trgm_ops)', False,
+         has_extension('pg_trgm')),
+        ('ix_archived_queues_name_trgm', 'archived_queues USING gin (lower(name) gin_trgm_ops)',
+         False, has_extension('pg_trgm')),
+    ], []),
+    (7, 'Queue ids are never reused after compaction', [
+        never_reuse_queue_ids,
+    ], [], []),
+    (8, 'Served attendants are kept', [
+        add_column('attendants', 'served_dt', 'TIMESTAMP'),
+    ], [], []),
+    (9, 'Joined subscription renamed after the close notices it gets', [
+        "UPDATE users SET subscription = 'closing' WHERE subscription = 'joined'",
+    ], [], []),
+]
+
+MIGRATION_LOCK_ID = 4231
+
+
+def _create_index(engine, name: str, target: str, unique: bool):
+    statement = f'CREATE {"UNIQUE " if unique else ""}INDEX {{}}IF NOT EXISTS {name} ON {target}'
+    if engine.dialect.name != 'postgresql':
+        with engine.begin() as conn:
+            conn.execute(text(statement.format('')))
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        # An interrupted CONCURRENTLY build leaves an invalid index that IF NOT EXISTS would skip
+        valid = conn.execute(text(
+            'SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = :name'), {'name': name}).scalar()
+        if valid is False:
+            conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+        conn.execute(text(statement.format('CONCURRENTLY ')))
+
+
+def _drop_index(engine, name: str):
+    if engine.dialect.name != 'postgresql':
+        with engine.begin() as conn:
+            conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+
+
+def _apply(engine):
+    with engine.connect() as conn:
+        applied = {row.version for row in conn.execute(
+            SchemaVersion.__table__.select())}
+    for version, description, fixes, indexes, dropped in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            for statement in fixes:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
+        for name, target, unique, *check in indexes:
+            if check:
+                with engine.connect() as conn:
+                    if not check[0](conn):
+                        continue
+            _create_index(engine, name, target, unique)
+        for name in dropped:
+            _drop_index(engine, name)
+        with engine.begin() as conn:
+            conn.execute(SchemaVersion.__table__.insert().values(
+                version=version, description=description, applied_dt=datetime.utcnow()))
+        print(f'[migrate] Applied version {version}: {description}')
+
+
+def migrate(engine):
+    if engine.dialect.name != 'postgresql':
+        return _apply(engine)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as lock_conn:
+        lock_conn.execute(text('SELECT pg_advisory_lock(:id)'), {'id': MIGRATION_LOCK_ID})
+        try:
+            _apply(engine)
+        finally:
+            lock_conn.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': MIGRATION_LOCK_ID})
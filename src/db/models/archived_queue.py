@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Integer, String, DateTime, Text
+
+from src.db.db_session import SQLAlchemyBase
+
+
+class ArchivedQueue(SQLAlchemyBase):
+    __tablename__ = 'archived_queues'
+
+    # Keeps the id of the compacted queue, so buttons and links to it keep working
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String)
+    start_dt = Column(DateTime)
+    end_dt = Column(DateTime)
+    notify_dt = Column(DateTime)
+    archived_dt = Column(DateTime)
+    attendants_count = Column(Integer, default=0)
+    # JSON list of [user_id, name, surname, served_dt] in queue order, served_dt in ISO format
+    attendants = Column(Text, default='[]')
+
+    status = 'archived'
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relation
 
 from src.db.db_session import SQLAlchemyBase
@@ -13,3 +13,9 @@ class Attendant(SQLAlchemyBase):
     queue_id = Column(Integer, ForeignKey('queues.id'))
     queue = relation('Queue', foreign_keys=queue_id)
     position = Column(Integer)
+    # Set when the user is called, served rows stay for the card history and attendance exports
+    served_dt = Column(DateTime)
+
+    __table_args__ = (Index('ux_attendants_queue_user', queue_id, user_id, unique=True),
+                      Index('ux_attendants_queue_position', queue_id, position, unique=True),
+                      Index('ix_attendants_user_id', user_id))
@@ -0,0 +1,32 @@
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Index
+
+from src.db.db_session import SQLAlchemyBase
+
+
+class OutboxMessage(SQLAlchemyBase):
+    __tablename__ = 'outbox_messages'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # No foreign key, so archive compaction can drop the queue while deliveries are kept
+    queue_id = Column(Integer)
+    event = Column(String)
+    text = Column(Text)
+    reply_markup = Column(Text, nullable=True)
+    parse_mode = Column(String, nullable=True)
+    created_dt = Column(DateTime)
+
+    __table_args__ = (Index('ux_outbox_messages_queue_event', queue_id, event, unique=True),)
+
+
+class Delivery(SQLAlchemyBase):
+    __tablename__ = 'deliveries'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    message_id = Column(Integer, ForeignKey('outbox_messages.id'))
+    user_id = Column(String)
+    status = Column(String, default='pending')  # pending, sent, blocked or failed
+    attempts = Column(Integer, default=0)
+    sent_dt = Column(DateTime, nullable=True)
+
+    __table_args__ = (Index('ux_deliveries_message_user', message_id, user_id, unique=True),
+                      Index('ix_deliveries_status_id', status, id))
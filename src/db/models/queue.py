@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Index, func
 from sqlalchemy.orm import relation
 
 from src.db.db_session import SQLAlchemyBase
@@ -18,3 +18,11 @@ class Queue(SQLAlchemyBase):
     status = Column(String, default='planned')
     notification_sent = Column(Boolean, default=False)
     attendants = relation('Attendant')
+
+    __table_args__ = (Index('ix_queues_status_id', status, id),
+                      Index('ix_queues_lower_name', func.lower(name)),
+                      Index('ix_queues_status_notify_dt', status, notify_dt),
+                      Index('ix_queues_status_start_dt', status, start_dt),
+                      Index('ix_queues_status_end_dt', status, end_dt),
+                      # Compaction deletes rows, their ids must not come back for new queues
+                      {'sqlite_autoincrement': True})
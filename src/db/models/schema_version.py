@@ -0,0 +1,11 @@
+from sqlalchemy import Column, Integer, String, DateTime
+
+from src.db.db_session import SQLAlchemyBase
+
+
+class SchemaVersion(SQLAlchemyBase):
+    __tablename__ = 'schema_versions'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String)
+    applied_dt = Column(DateTime)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean
+from sqlalchemy import Column, String, Boolean, Integer, Index
 from sqlalchemy.orm import relation
 
 from src.db.db_session import SQLAlchemyBase
@@ -11,4 +11,10 @@ class User(SQLAlchemyBase):
     name = Column(String)
     surname = Column(String)
     is_admin = Column(Boolean, default=False)
+    # Chats that blocked the bot or keep failing are left out of broadcasts until they come back
+    reachable = Column(Boolean, default=True)
+    failed_deliveries = Column(Integer, default=0)
+    subscription = Column(String, default='all')  # all, closing or mute
     attendants = relation('Attendant')
+
+    __table_args__ = (Index('ix_users_name_surname', name, surname),)
@@ -0,0 +1,191 @@
+import codecs
+import csv
+import heapq
+import io
+import json
+from collections import namedtuple
+from datetime import datetime, timedelta
+from tempfile import SpooledTemporaryFile
+
+from telegram import Update, ParseMode
+from telegram.ext import CallbackContext
+
+from src.cache import get_user
+from src.constants import EXPORT_FETCH, EXPORT_SPOOL_SIZE, EXPORT_PART_SIZE
+from src.db.db_session import read_session
+from src.db.models.archived_queue import ArchivedQueue
+from src.db.models.attendant import Attendant
+from src.db.models.queue import Queue
+from src.db.models.user import User
+from src.menu import menu
+from src.metrics import metrics
+from src.queue import QueueView
+from src.utils import delete_last_message
+
+ExportRow = namedtuple('ExportRow', 'queue_id queue_name start_dt end_dt position user_id name surname '
+                                    'served_dt')
+
+EXPORT_HEADER = ('queue_id', 'queue', 'start_dt', 'end_dt', 'position', 'user_id', 'name', 'surname',
+                 'served_dt')
+
+
+def _live_rows(session, queue_id: int = None, since: datetime = None, until: datetime = None):
+    query = session.query(Queue.id, Queue.name, Queue.start_dt, Queue.end_dt, Attendant.user_id,
+                          User.name, User.surname, Attendant.served_dt).join(
+        Attendant, Attendant.queue_id == Queue.id).join(User, User.id == Attendant.user_id)
+    if queue_id is not None:
+        query = query.filter(Queue.id == queue_id)
+    else:
+        query = query.filter((Queue.status == 'archived') & (Queue.start_dt >= since)
+                             & (Queue.start_dt < until))
+    position, last_queue_id = 0, None
+    # yield_per streams through a server-side cursor, positions are counted on the way
+    for row in query.order_by(Queue.start_dt, Queue.id, Attendant.position).yield_per(EXPORT_FETCH):
+        position = position + 1 if row[0] == last_queue_id else 1
+        last_queue_id = row[0]
+        yield ExportRow(*row[:4], position, *row[4:])
+
+
+def _archived_rows(session, queue_id: int = None, since: datetime = None, until: datetime = None):
+    query = session.query(ArchivedQueue.id, ArchivedQueue.name, ArchivedQueue.start_dt,
+                          ArchivedQueue.end_dt, ArchivedQueue.attendants)
+    if queue_id is not None:
+        query = query.filter(ArchivedQueue.id == queue_id)
+    else:
+        query = query.filter((ArchivedQueue.start_dt >= since) & (ArchivedQueue.start_dt < until))
+    # Only one compacted queue is unpacked at a time
+    for queue in query.order_by(ArchivedQueue.start_dt, ArchivedQueue.id).yield_per(
+            max(EXPORT_FETCH // 50, 1)):
+        attendants = json.loads(queue.attendants)
+        for position, (user_id, name, surname, *served) in enumerate(attendants, 1):
+            # Queues compacted before served rows were kept have no served_dt
+            served_dt = datetime.fromisoformat(served[0]) if served and served[0] else None
+            yield ExportRow(*queue[:4], position, user_id, name, surname, served_dt)
+
+
+def iter_attendance(session, queue_id: int = None, since: datetime = None,
+                    until: datetime = None):
+    # Both sources come sorted by queue start, merging them keeps the file in that order
+    return heapq.merge(_live_rows(session, queue_id, since, until),
+                       _archived_rows(session, queue_id, since, until),
+                       key=lambda row: (row.start_dt, row.queue_id))
+
+
+def write_csv(rows, new_file, part_size: int = EXPORT_PART_SIZE) -> tuple:
+    # Rows are encoded by hand, a text wrapper over a spooled file needs Python 3.11.
+    # Semicolons and a BOM, so spreadsheets in a Russian locale open the file as is.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';')
+    files, queues, count, last_queue_id = [], set(), 0, None
+
+    def flush():
+        files[-1].write(buffer.getvalue().encode())
+        buffer.seek(0)
+        buffer.truncate()
+
+    def start_part():
+        files.append(new_file())
+        files[-1].write(codecs.BOM_UTF8)
+        writer.writerow(EXPORT_HEADER)
+
+    start_part()
+    for row in rows:
+        if row.queue_id != last_queue_id or count % EXPORT_FETCH == 0:
+            flush()
+            # Parts are cut between queues once they are big enough, and inside a queue
+            # only when it alone would run past the document limit
+            size = files[-1].tell()
+            if count and (size >= part_size or
+                          (row.queue_id != last_queue_id and size >= part_size * 0.8)):
+                start_part()
+            last_queue_id = row.queue_id
+        writer.writerow((row.queue_id, row.queue_name, row.start_dt.strftime('%d.%m.%Y %H:%M:%S'),
+                         row.end_dt.strftime('%d.%m.%Y %H:%M:%S'), row.position, row.user_id,
+                         row.name, row.surname,
+                         row.served_dt.strftime('%d.%m.%Y %H:%M:%S') if row.served_dt else ''))
+        queues.add(row.queue_id)
+        count += 1
+    flush()
+    return files, len(queues), count
+
+
+def export_attendance(queue_id: int = None, since: datetime = None, until: datetime = None):
+    files = []
+
+    def new_file():
+        files.append(SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE))
+        return files[-1]
+
+    try:
+        with read_session() as session:
+            _, queues, count = write_csv(iter_attendance(session, queue_id, since, until),
+                                         new_file)
+    except Exception:
+        for file in files:
+            file.close()
+        raise
+    for file in files:
+        file.seek(0)
+    metrics.inc('exported_rows_total', count)
+    return files, queues, count
+
+
+def _parse_date(raw: str):
+    try:
+        return datetime.strptime(raw, '%d.%m.%Y')
+    except ValueError:
+        return None
+
+
+class QueueExport:
+    @staticmethod
+    def _send(context: CallbackContext, filename: str, queue_id: int = None,
+              since: datetime = None, until: datetime = None):
+        files, queues, count = export_attendance(queue_id, since, until)
+        try:
+            if not count:
+                return context.bot.send_message(context.user_data['id'], 'Выгружать нечего')
+            caption = f'Очередей: {queues}, записей: {count}'
+            # The upload is not streamed, PTB reads each part into memory before sending it
+            for i, file in enumerate(files, 1):
+                name, part = filename, caption
+                if len(files) > 1:
+                    name = filename.replace('.csv', f'_{i}.csv')
+                    part = f'{caption}\nЧасть {i} из {len(files)}'
+                context.bot.send_document(context.user_data['id'], file, filename=name,
+                                          caption=part)
+        finally:
+            for file in files:
+                file.close()
+
+    @staticmethod
+    @delete_last_message
+    def command(update: Update, context: CallbackContext):
+        context.user_data['id'] = str(update.message.from_user.id)
+        user = get_user(context.user_data['id'])
+        if not user or not user.is_admin:
+            return menu(update, context)
+        args = context.args or []
+        if len(args) == 1 and args[0].isdigit():
+            QueueExport._send(context, f'queue_{args[0]}.csv', queue_id=int(args[0]))
+        elif len(args) == 2 and _parse_date(args[0]) and _parse_date(args[1]):
+            since, until = _parse_date(args[0]), _parse_date(args[1]) + timedelta(days=1)
+            QueueExport._send(context, f'archive_{args[0]}-{args[1]}.csv', since=since,
+                              until=until)
+        else:
+            context.bot.send_message(
+                context.user_data['id'],
+                'Выгрузка очереди: /export <i>ID очереди</i>\n'
+                'Выгрузка архива: /export <i>ДД.ММ.ГГГГ ДД.ММ.ГГГГ</i> – '
+                'очереди, открывшиеся в эти дни', parse_mode=ParseMode.HTML)
+        return menu(update, context)
+
+    @staticmethod
+    @delete_last_message
+    def queue(update: Update, context: CallbackContext):
+        user = get_user(context.user_data['id'])
+        if not user or not user.is_admin:
+            return menu(update, context)
+        queue_id = int(context.match.string.split()[-1])
+        QueueExport._send(context, f'queue_{queue_id}.csv', queue_id=queue_id)
+        return QueueView.show(update, context)
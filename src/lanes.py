@@ -0,0 +1,100 @@
+import time
+from collections import deque
+from queue import Queue as TaskQueue
+from threading import Thread, Lock, Condition
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from src.constants import LANE_WORKERS
+from src.metrics import metrics
+
+
+# Updates of different users run in parallel, every user's updates one at a time in arrival
+# order, which is what ConversationHandler states and user_data mutations rely on
+class LaneDispatcher(Dispatcher):
+    def __init__(self, *args, lane_workers: int = LANE_WORKERS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lane_workers = lane_workers
+        self._lanes_lock = Lock()
+        self._drained = Condition(self._lanes_lock)
+        # A user has a lane while their updates are waiting or running, and the lane is in
+        # _ready (or taken by a worker) exactly once, which is what keeps their updates in order
+        self._lanes = {}
+        self._ready = TaskQueue()
+        self._pending = 0
+        self._lane_threads = []
+
+    @staticmethod
+    def lane_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    def start(self, ready=None):
+        self._start_lanes()
+        super().start(ready)
+
+    def stop(self):
+        # The dispatcher loop hands every queued update over to the lanes before it stops
+        super().stop()
+        with self._lanes_lock:
+            while self._pending:
+                self._drained.wait()
+            threads, self._lane_threads = self._lane_threads, []
+        for _ in threads:
+            self._ready.put(None)
+        for thread in threads:
+            thread.join()
+
+    def process_update(self, update):
+        key = self.lane_key(update)
+        if key is None or not self._lane_threads:
+            return super().process_update(update)
+        with self._lanes_lock:
+            self._pending += 1
+            lane = self._lanes.get(key)
+            if lane is not None:
+                lane.append((update, time.monotonic()))
+                return
+            self._lanes[key] = deque([(update, time.monotonic())])
+        self._ready.put(key)
+
+    def _start_lanes(self):
+        with self._lanes_lock:
+            if self._lane_threads:
+                return
+            self._lane_threads = [Thread(target=self._lane_worker, name=f'lane_{i}', daemon=True)
+                                  for i in range(self.lane_workers)]
+        for thread in self._lane_threads:
+            thread.start()
+        metrics.gauge('lane_pending_updates', lambda: self._pending)
+        metrics.gauge('lane_active_users', lambda: len(self._lanes))
+
+    def _lane_worker(self):
+        while True:
+            key = self._ready.get()
+            if key is None:
+                return
+            with self._lanes_lock:
+                update, queued = self._lanes[key][0]
+            metrics.observe('lane_wait_seconds', time.monotonic() - queued)
+            try:
+                super().process_update(update)
+            except Exception as e:
+                print(f'[lanes] Update of {key=} failed: {e}')
+            with self._lanes_lock:
+                lane = self._lanes[key]
+                lane.popleft()
+                self._pending -= 1
+                if not lane:
+                    del self._lanes[key]
+                if not self._pending:
+                    self._drained.notify_all()
+                reschedule = bool(lane)
+            if reschedule:
+                # Back of the line, so one busy user can't starve the others
+                self._ready.put(key)
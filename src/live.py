@@ -0,0 +1,143 @@
+import time
+from threading import Thread, Event, RLock
+
+from telegram import ParseMode
+from telegram.error import BadRequest, Unauthorized, RetryAfter
+
+from src.broadcast import limiter
+from src.cache import get_queue_card, add_version_listener, get_user
+from src.constants import LIVE_UPDATE_INTERVAL, LIVE_VIEW_TTL
+from src.outbox import delivery_summary
+from src.utils import get_screen_hash, render_queue_card
+
+
+class Viewer:
+    __slots__ = ('message_id', 'screen_hash', 'page', 'since', 'pushed')
+
+    def __init__(self, message_id: int, screen_hash: int, page: int = None):
+        self.message_id = message_id
+        self.screen_hash = screen_hash
+        self.page = page
+        self.since = time.monotonic()
+        self.pushed = 0.0
+
+
+class LiveViews:
+    def __init__(self, interval: float = LIVE_UPDATE_INTERVAL, ttl: float = LIVE_VIEW_TTL):
+        self.interval = interval
+        self.ttl = ttl
+        self.bot = None
+        self.dispatcher = None
+        self._lock = RLock()
+        self._viewers = {}
+        self._watching = {}
+        self._pending = set()
+        self._wake = Event()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self, bot, dispatcher):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        add_version_listener(self.changed)
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='live_views', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def watch(self, chat_id: str, queue_id: int, message_id: int, screen_hash: int,
+              page: int = None):
+        with self._lock:
+            self.unwatch(chat_id)
+            self._viewers.setdefault(queue_id, {})[chat_id] = Viewer(message_id, screen_hash, page)
+            self._watching[chat_id] = queue_id
+
+    def unwatch(self, chat_id: str):
+        with self._lock:
+            queue_id = self._watching.pop(chat_id, None)
+            viewers = self._viewers.get(queue_id)
+            if viewers is not None:
+                viewers.pop(chat_id, None)
+                if not viewers:
+                    del self._viewers[queue_id]
+
+    def changed(self, queue_id: int):
+        with self._lock:
+            if queue_id not in self._viewers:
+                return
+            self._pending.add(queue_id)
+        self._wake.set()
+
+    def _still_viewing(self, chat_id: str, viewer: Viewer) -> bool:
+        # Any other screen rendered in the chat changes its hash, which means the user moved on
+        user_data = self.dispatcher.user_data.get(int(chat_id)) if self.dispatcher else None
+        return (time.monotonic() - viewer.since < self.ttl and user_data is not None
+                and user_data.get('message_id') == viewer.message_id
+                and user_data.get('screen_hash') == viewer.screen_hash)
+
+    def _push(self, queue_id: int) -> bool:
+        card = get_queue_card(queue_id)
+        now = time.monotonic()
+        with self._lock:
+            viewers = list(self._viewers.get(queue_id, {}).items())
+        deferred = False
+        for chat_id, viewer in viewers:
+            if not card or not self._still_viewing(chat_id, viewer):
+                self.unwatch(chat_id)
+                continue
+            if now - viewer.pushed < self.interval:
+                deferred = True
+                continue
+            user = get_user(chat_id)
+            is_admin = bool(user and user.is_admin)
+            text, markup = render_queue_card(card, chat_id, is_admin,
+                                             delivery_summary(queue_id) if is_admin else (),
+                                             viewer.page)
+            screen_hash = get_screen_hash(text, markup)
+            if screen_hash == viewer.screen_hash:
+                continue
+            limiter.acquire(chat_id)
+            try:
+                self.bot.edit_message_text(text, chat_id, viewer.message_id, reply_markup=markup,
+                                           parse_mode=ParseMode.HTML)
+            except RetryAfter as e:
+                limiter.pause(e.retry_after)
+                deferred = True
+                continue
+            except BadRequest as e:
+                if 'not modified' not in str(e):
+                    self.unwatch(chat_id)
+                    continue
+            except Unauthorized:
+                self.unwatch(chat_id)
+                continue
+            viewer.pushed = time.monotonic()
+            viewer.screen_hash = screen_hash
+            user_data = self.dispatcher.user_data.get(int(chat_id))
+            if user_data is not None:
+                user_data['screen_hash'] = screen_hash
+        return deferred
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            for queue_id in pending:
+                try:
+                    if self._push(queue_id):
+                        with self._lock:
+                            self._pending.add(queue_id)
+                except Exception as e:
+                    print(f'[live_views] Push for {queue_id=} failed: {e}')
+
+
+live_views = LiveViews()
@@ -2,19 +2,19 @@ import os
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 
-from src.constants import MENU_STATUS_VERBOSES
+from src.cache import get_status_counts, get_user, invalidate_user
+from src.constants import MENU_STATUS_VERBOSES, SUBSCRIPTION_VERBOSES
 from src.db.db_session import create_session
-from src.db.models.queue import Queue
 from src.db.models.user import User
-from src.utils import delete_last_message
+from src.utils import delete_last_message, send_screen
 
 
 @delete_last_message
-def ask_name(_, context):
+def ask_name(update, context):
     context.user_data['reg_data'] = dict()
     markup = InlineKeyboardMarkup([[InlineKeyboardButton('Вернуться назад', callback_data='back')]])
-    return (context.bot.send_message(
-        context.user_data['id'], 'Введите своё имя', reply_markup=markup), 'ask_name')
+    return (send_screen(
+        update, context, 'Введите своё имя', reply_markup=markup), 'ask_name')
 
 
 @delete_last_message
@@ -27,8 +27,8 @@ def ask_surname(update, context):
             return ask_name(update, context)
         context.user_data['reg_data']['name'] = name
     markup = InlineKeyboardMarkup([[InlineKeyboardButton('Вернуться назад', callback_data='back')]])
-    return (context.bot.send_message(
-        context.user_data['id'], 'Введите свою фамилию', reply_markup=markup), 'ask_surname')
+    return (send_screen(
+        update, context, 'Введите свою фамилию', reply_markup=markup), 'ask_surname')
 
 
 @delete_last_message
@@ -50,6 +50,7 @@ def finish_registration(update, context):
                     is_admin=str(context.user_data['id']) == os.getenv('super_admin_id', ''))
         session.add(user)
         session.commit()
+    invalidate_user(context.user_data['id'])
     context.bot.send_message(context.user_data['id'], 'Регистрация была успешно завершена')
     return menu(update, context)
 
@@ -63,23 +64,58 @@ def menu(update, context):
         user_id = context.user_data['id']
     else:
         return 'menu'
-    with create_session() as session:
-        user = session.query(User).get(user_id)
-        if not user:
-            context.bot.send_message(context.user_data['id'],
-                                     'Здравствуйте, это бот очередей группы 4231 ГУАП.\n'
-                                     'Пройдите, пожалуйста, регистрацию')
-            return ask_name(update, context)
-        buttons = []
-        for status in ('active', 'planned', 'archived'):
-            if session.query(Queue).filter(Queue.status == status).first():
-                buttons.append([InlineKeyboardButton(f'{MENU_STATUS_VERBOSES[status]} очереди',
-                                                     callback_data=status)])
-        if user.is_admin:
-            buttons.append([InlineKeyboardButton('Добавить очередь', callback_data='add_queue')])
-        markup, submsg = ((InlineKeyboardMarkup(buttons), '') if buttons else
-                          (None, '\n\nНикаких очередей пока нет'))
-        markup = InlineKeyboardMarkup(buttons) if buttons else None
-    return context.bot.send_message(
-        context.user_data['id'], f'<b>Пользователь:</b> {user.name} {user.surname}{submsg}',
-        reply_markup=markup, parse_mode=ParseMode.HTML), 'menu'
+    user = get_user(user_id)
+    if not user:
+        context.bot.send_message(context.user_data['id'],
+                                 'Здравствуйте, это бот очередей группы 4231 ГУАП.\n'
+                                 'Пройдите, пожалуйста, регистрацию')
+        return ask_name(update, context)
+    if not user.reachable and update.message is not None:
+        # Writing to the bot again means it was unblocked
+        with create_session() as session:
+            session.query(User).filter(User.id == user_id).update(
+                {'reachable': True, 'failed_deliveries': 0})
+            session.commit()
+        invalidate_user(user_id)
+    buttons = []
+    status_counts = get_status_counts()
+    for status in ('active', 'planned', 'archived'):
+        if status_counts.get(status):
+            buttons.append([InlineKeyboardButton(
+                f'{MENU_STATUS_VERBOSES[status]} очереди ({status_counts[status]})',
+                callback_data=status)])
+    submsg = '' if buttons else '\n\nНикаких очередей пока нет'
+    if user.is_admin:
+        buttons.append([InlineKeyboardButton('Добавить очередь', callback_data='add_queue')])
+        buttons.append([InlineKeyboardButton('Импорт очередей', callback_data='import_queues')])
+    buttons.append([InlineKeyboardButton('Настройки рассылок', callback_data='settings')])
+    return send_screen(
+        update, context, f'<b>Пользователь:</b> {user.name} {user.surname}{submsg}',
+        reply_markup=InlineKeyboardMarkup(buttons), parse_mode=ParseMode.HTML), 'menu'
+
+
+@delete_last_message
+def settings(update, context):
+    user = get_user(context.user_data['id'])
+    if not user:
+        return menu(update, context)
+    buttons = [[InlineKeyboardButton(f'{"✅ " if user.subscription == key else ""}{verbose}',
+                                     callback_data=f'sub {key}')]
+               for key, verbose in SUBSCRIPTION_VERBOSES.items()]
+    buttons.append([InlineKeyboardButton('Вернуться назад', callback_data='back')])
+    return send_screen(
+        update, context, '<b>О каких очередях присылать уведомления?</b>\n\n'
+                         '<i>Сообщения о том, что подходит ваша очередь, приходят всегда</i>',
+        reply_markup=InlineKeyboardMarkup(buttons), parse_mode=ParseMode.HTML), 'settings'
+
+
+@delete_last_message
+def set_subscription(update, context):
+    subscription = context.match.string.split()[-1]
+    if subscription in SUBSCRIPTION_VERBOSES:
+        with create_session() as session:
+            session.query(User).filter(User.id == context.user_data['id']).update(
+                {'subscription': subscription})
+            session.commit()
+        invalidate_user(context.user_data['id'])
+    return settings(update, context)
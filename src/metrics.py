@@ -0,0 +1,208 @@
+import os
+import time
+from collections import defaultdict
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread, Event, Lock, local
+
+from sqlalchemy import event
+from telegram.error import TelegramError
+from telegram.utils.request import Request
+
+from src.constants import METRICS_BUCKETS, METRICS_FILE_INTERVAL
+
+_db = local()
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format(name: str, labels: tuple, value) -> str:
+    if not labels:
+        return f'{name} {value}'
+    pairs = ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"'))
+                     for key, value in labels)
+    return f'{name}{{{pairs}}} {value}'
+
+
+class Metrics:
+    def __init__(self, buckets: tuple = METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._gauges = {}
+        self._server = None
+        self._writer = None
+        self._stop = Event()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[name, _labels(labels)] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = name, _labels(labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts, then sum and count
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def gauge(self, name: str, func):
+        self._gauges[name] = func
+
+    def timed(self, func, name: str, kind: str = 'handler'):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            queries, db_seconds = getattr(_db, 'queries', 0), getattr(_db, 'seconds', 0.0)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                self.inc(f'{kind}_errors_total', **{kind: name, 'error': type(e).__name__})
+                raise
+            finally:
+                self.observe(f'{kind}_seconds', time.perf_counter() - started, **{kind: name})
+                self.inc(f'{kind}_db_queries_total', getattr(_db, 'queries', 0) - queries,
+                         **{kind: name})
+                self.inc(f'{kind}_db_seconds_total', getattr(_db, 'seconds', 0.0) - db_seconds,
+                         **{kind: name})
+
+        return wrapper
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(value)) for key, value in self._histograms.items())
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(_format(name, labels, value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, count in zip(self.buckets, histogram):
+                lines.append(_format(f'{name}_bucket', labels + (('le', str(bound)),), count))
+            lines.append(_format(f'{name}_bucket', labels + (('le', '+Inf'),), histogram[-1]))
+            lines.append(_format(f'{name}_sum', labels, histogram[-2]))
+            lines.append(_format(f'{name}_count', labels, histogram[-1]))
+        for name, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                print(f'[metrics] Gauge {name} failed: {e}')
+                continue
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(_format(name, (), value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        # Write and rename, so readers never see a half-written file
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.render())
+        os.replace(path + '.tmp', path)
+
+    def start(self, port: int = None, path: str = None, host: str = '0.0.0.0',
+              interval: float = METRICS_FILE_INTERVAL):
+        self._stop.clear()
+        if port and self._server is None:
+            self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+            self._server.metrics = self
+            Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+            print(f'[metrics] Serving on {host}:{port}/metrics')
+        if path and self._writer is None:
+            self._writer = Thread(target=self._write_periodically, args=(path, interval),
+                                  name='metrics_file', daemon=True)
+            self._writer.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def _write_periodically(self, path: str, interval: float):
+        while True:
+            stopping = self._stop.wait(interval)
+            try:
+                self.write(path)
+            except OSError as e:
+                print(f'[metrics] Writing {path} failed: {e}')
+            if stopping:
+                return
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+metrics = Metrics()
+
+
+class InstrumentedRequest(Request):
+    def post(self, url: str, data, timeout: float = None):
+        method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return super().post(url, data, timeout)
+        except TelegramError as e:
+            metrics.inc('bot_api_errors_total', method=method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe('bot_api_seconds', time.perf_counter() - started, method=method)
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        _db.queries = getattr(_db, 'queries', 0) + 1
+        _db.seconds = getattr(_db, 'seconds', 0.0) + elapsed
+        metrics.observe('db_query_seconds', elapsed, operation=statement.split(None, 1)[0].upper())
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('query_started'):
+            connection.info['query_started'].pop()
+        metrics.inc('db_errors_total', error=type(exception_context.original_exception).__name__)
+
+
+def instrument_conversation(conv_handler):
+    handlers = list(conv_handler.entry_points) + list(conv_handler.fallbacks)
+    for state_handlers in conv_handler.states.values():
+        handlers.extend(state_handlers)
+    for handler in handlers:
+        handler.callback = metrics.timed(handler.callback, handler.callback.__qualname__)
+    return conv_handler
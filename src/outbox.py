@@ -0,0 +1,184 @@
+import json
+from itertools import groupby
+from threading import Thread, Event
+
+from sqlalchemy import func, insert, select, literal, exists, case
+from telegram import InlineKeyboardMarkup
+from telegram.error import Unauthorized, BadRequest
+
+from src.broadcast import broadcast
+from src.cache import invalidate_user
+from src.constants import (OUTBOX_BATCH, OUTBOX_MAX_ATTEMPTS, OUTBOX_POLL_INTERVAL,
+                           DELIVERY_EVENT_VERBOSES, DEAD_CHAT_FAILURES)
+from src.db.db_session import create_session, read_session
+from src.db.models.attendant import Attendant
+from src.db.models.outbox import OutboxMessage, Delivery
+from src.db.models.user import User
+from src.metrics import metrics
+from src.utils import local_now
+
+# Bad requests caused by the recipient rather than by the message
+CHAT_ERRORS = ('chat not found', 'user is deactivated', 'peer_id_invalid', 'chat_id is empty')
+
+
+def enqueue(session, queue_id: int, event: str, text: str, reply_markup=None,
+            parse_mode: str = None) -> bool:
+    # Runs in the caller's transaction, so a queue transition and its announcement commit together
+    if session.query(OutboxMessage.id).filter(
+            (OutboxMessage.queue_id == queue_id) & (OutboxMessage.event == event)).first():
+        return False
+    message = OutboxMessage(queue_id=queue_id, event=event, text=text, parse_mode=parse_mode,
+                            reply_markup=json.dumps(reply_markup.to_dict()) if reply_markup else None,
+                            created_dt=local_now())
+    session.add(message)
+    session.flush()
+    session.execute(insert(Delivery).from_select(
+        ['message_id', 'user_id', 'status', 'attempts'],
+        select(literal(message.id), User.id, literal('pending'), literal(0)).where(
+            audience(queue_id))))
+    return True
+
+
+def audience(queue_id: int):
+    # Nobody is in a queue before it opens, so 'closing' users only ever hear about the close
+    joined = exists().where((Attendant.queue_id == queue_id) & (Attendant.user_id == User.id))
+    return ((User.reachable.isnot(False)) &
+            ((User.subscription.is_(None)) | (User.subscription == 'all') |
+             ((User.subscription == 'closing') & joined)))
+
+
+def is_chat_error(error: BadRequest) -> bool:
+    message = str(error).lower()
+    return any(reason in message for reason in CHAT_ERRORS)
+
+
+def delivery_counts(queue_id: int) -> dict:
+    counts = {}
+    with read_session() as session:
+        for event, status, count in session.query(
+                OutboxMessage.event, Delivery.status, func.count(Delivery.id)).join(
+                Delivery, Delivery.message_id == OutboxMessage.id).filter(
+                OutboxMessage.queue_id == queue_id).group_by(OutboxMessage.event, Delivery.status):
+            counts.setdefault(event, {})[status] = count
+    return counts
+
+
+def delivery_summary(queue_id: int) -> list:
+    lines = []
+    all_counts = delivery_counts(queue_id)
+    for event in DELIVERY_EVENT_VERBOSES:
+        counts = all_counts.get(event)
+        if not counts:
+            continue
+        line = (f'<b>Рассылка ({DELIVERY_EVENT_VERBOSES[event]}):</b> '
+                f'доставлено {counts.get("sent", 0)} из {sum(counts.values())}')
+        for status, verbose in (('pending', 'в очереди'), ('blocked', 'недоступны'),
+                                ('failed', 'ошибки')):
+            if counts.get(status):
+                line += f', {verbose} {counts[status]}'
+        lines.append(line)
+    return lines
+
+
+class Outbox:
+    def __init__(self, batch_size: int = OUTBOX_BATCH, poll_interval: float = OUTBOX_POLL_INTERVAL,
+                 max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.bot = None
+        self._wake = Event()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self, bot):
+        self.bot = bot
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='outbox', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wake(self):
+        self._wake.set()
+
+    def drain(self) -> int:
+        with read_session() as session:
+            rows = session.query(Delivery.id, Delivery.message_id, Delivery.user_id,
+                                 Delivery.attempts).filter(Delivery.status == 'pending').order_by(
+                Delivery.id).limit(self.batch_size).all()
+            messages = {message.id: (message.queue_id, message.event, message.text,
+                                     message.reply_markup, message.parse_mode)
+                        for message in session.query(OutboxMessage).filter(
+                            OutboxMessage.id.in_({row.message_id for row in rows}))}
+        for message_id, group in groupby(sorted(rows, key=lambda row: row.message_id),
+                                         key=lambda row: row.message_id):
+            group = list(group)
+            queue_id, event, text, reply_markup, parse_mode = messages[message_id]
+            kwargs = {'parse_mode': parse_mode}
+            if reply_markup:
+                kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(json.loads(reply_markup),
+                                                                      self.bot)
+            by_user = {row.user_id: row for row in group}
+            broadcast(self.bot, list(by_user), text, tag=f'outbox {event} {queue_id=}',
+                      on_result=lambda user_id, error: self._record(
+                          by_user[user_id], error, queue_id, event), **kwargs)
+        return len(rows)
+
+    def _record(self, row, error, queue_id: int, event: str):
+        values, health = {'attempts': Delivery.attempts + 1}, None
+        failures = func.coalesce(User.failed_deliveries, 0)
+        if error is None:
+            status = 'sent'
+            values['sent_dt'] = local_now()
+        elif isinstance(error, Unauthorized):
+            # Blocked bots and deactivated accounts never come back on their own
+            status, health = 'blocked', {'reachable': False, 'failed_deliveries': failures + 1}
+        elif isinstance(error, BadRequest) and is_chat_error(error):
+            # A strike counts against the chat and skips it once there are too many in a row
+            status, health = 'blocked', {'failed_deliveries': failures + 1, 'reachable': case(
+                (failures + 1 >= DEAD_CHAT_FAILURES, False), else_=User.reachable)}
+        elif isinstance(error, BadRequest):
+            # The message itself is broken, which says nothing about the chat
+            status = 'failed'
+        elif row.attempts + 1 >= self.max_attempts:
+            # Network errors and flood waits are on our side, so they never count against the chat
+            status = 'failed'
+        else:
+            status = 'pending'
+        values['status'] = status
+        # Every outcome is committed as soon as it is known, so a crash repeats at most the
+        # messages that were in flight
+        with create_session() as session:
+            if error is None:
+                session.query(User).filter(
+                    (User.id == row.user_id) & (User.failed_deliveries > 0)).update(
+                    {'failed_deliveries': 0}, synchronize_session=False)
+            elif health:
+                session.query(User).filter(User.id == row.user_id).update(
+                    health, synchronize_session=False)
+            session.query(Delivery).filter(Delivery.id == row.id).update(
+                values, synchronize_session=False)
+            session.commit()
+        metrics.inc('deliveries_total', queue=queue_id, event=event, status=status)
+        if health:
+            invalidate_user(row.user_id)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                if self.drain():
+                    continue
+            except Exception as e:
+                print(f'[outbox] {e}')
+            self._wake.wait(self.poll_interval)
+
+
+outbox = Outbox()
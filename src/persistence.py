@@ -0,0 +1,211 @@
+import json
+import time
+from collections import defaultdict, OrderedDict
+from threading import Thread, Event, Lock, RLock
+
+from telegram.ext import BasePersistence
+
+from src.constants import (PERSISTENCE_FLUSH_INTERVAL, PERSISTENCE_MAX_RESIDENT,
+                           PERSISTENCE_BUSY_TIMEOUT)
+from src.db.db_session import create_session
+from src.db.models.state import State
+
+
+class LazyUserData(defaultdict):
+    def __init__(self, persistence: 'DBPersistence'):
+        super().__init__(dict)
+        self._persistence = persistence
+
+    def __missing__(self, user_id):
+        self._persistence.hydrate(user_id)
+        return self.setdefault(user_id, {})
+
+
+class LazyConversations(dict):
+    def __init__(self, persistence: 'DBPersistence'):
+        super().__init__()
+        self._persistence = persistence
+
+    def get(self, key, default=None):
+        self._persistence.hydrate(key[-1])
+        return super().get(key, default)
+
+
+class DBPersistence(BasePersistence):
+    def __init__(self, flush_interval: float = PERSISTENCE_FLUSH_INTERVAL, lazy: bool = True,
+                 max_resident: int = PERSISTENCE_MAX_RESIDENT):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.flush_interval = flush_interval
+        self.lazy = lazy
+        self.max_resident = max_resident
+        self._user_data = None
+        self._conversations = None
+        self._resident = OrderedDict()
+        self._hydrate_lock = RLock()
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._callbacks = {}
+        self._saved = {}
+        self._dirty = {}
+        self._flushing = {}
+        self._busy = {}
+        self._stop = Event()
+        self._thread = None
+
+    # user_data only holds JSON, so there is never a Bot instance to swap in or out
+    def insert_bot(self, obj):
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def get_user_data(self) -> defaultdict:
+        if self.lazy:
+            self._user_data = LazyUserData(self)
+            return self._user_data
+        self._user_data = defaultdict(dict)
+        with create_session() as session:
+            for state in session.query(State).all():
+                self._load(state)
+        return self._user_data
+
+    def get_chat_data(self) -> defaultdict:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> dict:
+        return {}
+
+    def get_conversations(self, name: str) -> dict:
+        self._conversations = LazyConversations(self) if self.lazy else {}
+        for user_id, callback in self._callbacks.items():
+            if callback is not None:
+                self._conversations[(user_id, user_id)] = callback
+        return self._conversations
+
+    def _load(self, state: State):
+        user_id = int(state.user_id)
+        with self._lock:
+            self._saved[user_id] = (state.callback, state.data)
+        self._restore(user_id, state.callback, state.data)
+
+    def _restore(self, user_id: int, callback, str_data):
+        # Whatever is already in memory is newer than anything read back
+        with self._lock:
+            callback = self._callbacks.setdefault(user_id, callback)
+        dict.setdefault(self._user_data, user_id, json.loads(str_data) if str_data else {})
+        if self._conversations is not None and callback is not None:
+            dict.setdefault(self._conversations, (user_id, user_id), callback)
+
+    def hydrate(self, user_id: int):
+        with self._hydrate_lock:
+            # Accessed for an update, released once its user_data is handed back
+            self._busy[user_id] = time.monotonic()
+            if user_id in self._resident:
+                self._resident.move_to_end(user_id)
+                return
+            self._resident[user_id] = True
+            with self._lock:
+                newer = self._dirty.get(user_id) or self._flushing.get(user_id)
+            if newer:
+                # Changes that have not reached the database yet win over its row
+                self._restore(user_id, *newer)
+            else:
+                with create_session() as session:
+                    state = session.query(State).get(str(user_id))
+                    if state:
+                        self._load(state)
+            self._evict()
+
+    def _evict(self):
+        with self._lock:
+            dirty = set(self._dirty) | set(self._flushing)
+        now = time.monotonic()
+        for user_id in list(self._resident):
+            if len(self._resident) <= self.max_resident:
+                return
+            if user_id in dirty or now - self._busy.get(user_id, 0) < PERSISTENCE_BUSY_TIMEOUT:
+                continue
+            del self._resident[user_id]
+            self._busy.pop(user_id, None)
+            with self._lock:
+                self._callbacks.pop(user_id, None)
+                self._saved.pop(user_id, None)
+            dict.pop(self._user_data, user_id, None)
+            if self._conversations is not None:
+                dict.pop(self._conversations, (user_id, user_id), None)
+
+    def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        user_id = key[-1]
+        with self._lock:
+            self._callbacks[user_id] = new_state
+            saved = self._saved.get(user_id)
+            if user_id in self._dirty:
+                self._dirty[user_id] = (new_state, self._dirty[user_id][1])
+            elif saved is None or saved[0] != new_state:
+                self._dirty[user_id] = (new_state, saved[1] if saved else None)
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        str_data = json.dumps(data)
+        self._busy.pop(user_id, None)
+        with self._lock:
+            callback = self._callbacks.get(user_id)
+            if self._dirty.get(user_id, self._saved.get(user_id)) != (callback, str_data):
+                self._dirty[user_id] = (callback, str_data)
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    def update_bot_data(self, data: dict) -> None:
+        pass
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='persistence', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'[persistence] Flush failed: {e}')
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+                self._flushing = dirty
+            if not dirty:
+                return
+            try:
+                with create_session() as session:
+                    # Row locks keep workers from interleaving writes to one user's state
+                    states = {state.user_id: state for state in session.query(State).filter(
+                        State.user_id.in_([str(user_id) for user_id in dirty])).with_for_update()}
+                    for user_id, (callback, str_data) in dirty.items():
+                        state = states.get(str(user_id))
+                        if state:
+                            state.callback = callback
+                            state.data = str_data
+                        else:
+                            session.add(State(user_id=str(user_id), callback=callback,
+                                              data=str_data))
+                    session.commit()
+            except Exception:
+                with self._lock:
+                    for user_id, values in dirty.items():
+                        self._dirty.setdefault(user_id, values)
+                    self._flushing = {}
+                raise
+            with self._lock:
+                self._saved.update(dirty)
+                self._flushing = {}
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
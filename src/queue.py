@@ -1,87 +1,81 @@
-from datetime import datetime, timedelta
+import html
+from datetime import datetime
 
 from sqlalchemy import func
 from telegram import Update, ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import TelegramError
 from telegram.ext import CallbackContext
 
-from src.constants import STATUS_VERBOSES, PAGINATION_STEP, VIEW_STATUS_VERBOSES, MIN_DELTA, MIN_DUR
-from src.db.db_session import create_session
-from src.db.models.attendant import Attendant
+from src.cache import (invalidate_status_counts, get_status_counts, bump_queue_version,
+                       get_queue_card, get_user)
+from src.constants import STATUS_VERBOSES, PAGINATION_STEP, VIEW_STATUS_VERBOSES
+from src.db.db_session import create_session, read_session
+from src.db.models.archived_queue import ArchivedQueue
 from src.db.models.queue import Queue
-from src.db.models.user import User
+from src.live import live_views
 from src.menu import menu
-from src.utils import build_pagination, delete_last_message, parse_dt
+from src.outbox import enqueue, outbox, delivery_summary
+from src.registration import pipeline, leave, swap_with_next, advance
+from src.scheduler import scheduler
+from src.search import queue_search
+from src.utils import (build_pagination, count_pages, delete_last_message, parse_dt,
+                       format_queue_info, local_now, send_screen, render_queue_card,
+                       check_start_dt, check_end_dt, check_notify_dt)
 
 
-def notify_queue(context: CallbackContext):
-    try:
-        queue_id = int(context.job.name)
-    except ValueError:
-        return print(f'[notify_queue] Something went wrong on {context.job.name=}')
+def notify_queue(bot, queue_id: int):
     with create_session() as session:
         q = session.query(Queue).get(queue_id)
         if not q:
             return print(f'[notify_queue] No queue with id = {queue_id}')
         if q.notification_sent:
             return print(f'[notify_queue] Notification has already been sent')
-        for user in session.query(User).all():
-            context.bot.send_message(
-                user.id, f'Очередь <b>{q.name}</b> откроется в '
-                         f'<b>{q.start_dt.strftime("%d.%m.%Y %H:%M")}</b>',
-                parse_mode=ParseMode.HTML)
+        enqueue(session, q.id, 'notify',
+                f'Очередь <b>{html.escape(q.name)}</b> откроется в '
+                f'<b>{q.start_dt.strftime("%d.%m.%Y %H:%M")}</b>', parse_mode=ParseMode.HTML)
         q.notification_sent = True
         session.add(q)
         session.commit()
+    outbox.wake()
 
 
-def open_queue(context: CallbackContext):
-    try:
-        queue_id = int(context.job.name)
-    except ValueError:
-        return print(f'[open_queue] Something went wrong on {context.job.name=}')
+def open_queue(bot, queue_id: int):
     with create_session() as session:
         q = session.query(Queue).get(queue_id)
         if not q:
             return print(f'[open_queue] No queue with id = {queue_id}')
         if q.status != 'planned':
-            return print(f'[open_queue] {q.status=} on {context.job.name=}')
+            return print(f'[open_queue] {q.status=} on {queue_id=}')
         q.status = 'active'
-        session.add(q)
-        session.commit()
-        text = []
-        for attr in Queue.verbose_attrs:
-            val = getattr(q, attr)
-            if 'dt' in attr:
-                val = val.strftime('%d.%m.%Y %H:%M:%S')
-            if attr == 'status':
-                val = VIEW_STATUS_VERBOSES.get(val, val)
-            text.append(f'<b>{Queue.verbose_attrs.get(attr, attr)}:</b> {val}')
         markup = InlineKeyboardMarkup([
             [InlineKeyboardButton('Встать в очередь', callback_data=f'reg {q.id}')]])
-        for user in session.query(User).all():
-            context.bot.send_message(
-                user.id,
-                f'<b>Открылась новая очередь!</b>\n\n' + '\n'.join(text),
+        enqueue(session, q.id, 'open',
+                f'<b>Открылась новая очередь!</b>\n\n' + '\n'.join(format_queue_info(q)),
                 reply_markup=markup, parse_mode=ParseMode.HTML)
+        session.add(q)
+        session.commit()
+    invalidate_status_counts()
+    bump_queue_version(queue_id)
+    outbox.wake()
 
 
-def close_queue(context: CallbackContext):
-    try:
-        queue_id = int(context.job.name)
-    except ValueError:
-        return print(f'[close_queue] Something went wrong on {context.job.name=}')
+def close_queue(bot, queue_id: int):
     with create_session() as session:
         q = session.query(Queue).get(queue_id)
         if not q:
             return print(f'[close_queue] No queue with id = {queue_id}')
-        if q.status != 'active':
-            return print(f'[close_queue] {q.status=} on {context.job.name=}')
-        for user in session.query(User).all():
-            context.bot.send_message(user.id, f'Очередь <b>{q.name}</b> была закрыта',
-                                     parse_mode=ParseMode.HTML)
+        if q.status == 'archived':
+            return print(f'[close_queue] {q.status=} on {queue_id=}')
+        # A queue that never opened was missed while the bot was down, nobody needs to hear about it
+        if q.status == 'active':
+            enqueue(session, q.id, 'close', f'Очередь <b>{html.escape(q.name)}</b> была закрыта',
+                    parse_mode=ParseMode.HTML)
         q.status = 'archived'
         session.add(q)
         session.commit()
+    invalidate_status_counts()
+    bump_queue_version(queue_id)
+    outbox.wake()
 
 
 class QueueView:
@@ -94,73 +88,101 @@ class QueueView:
             return menu(update, context)
         if status not in ('planned', 'active', 'archived'):
             status = context.user_data.get('last_queue_status')
-        with create_session() as session:
+        total = get_status_counts().get(status, 0)
+        if not total:
+            context.bot.send_message(context.user_data['id'],
+                                     f'Очередей со статусом {status} пока нет!')
+            return menu(update, context)
+        context.user_data['last_queue_status'] = status
+        pages_count = count_pages(total, PAGINATION_STEP)
+        page = min(max(context.user_data.get('pagination') or 1, 1), pages_count)
+        context.user_data['pagination'] = page
+        context.user_data['pages_count'] = pages_count
+        with read_session() as session:
+            query = session.query(Queue.id, Queue.name, Queue.start_dt, Queue.end_dt).filter(
+                Queue.status == status)
+            if status == 'archived':
+                query = query.union_all(session.query(
+                    ArchivedQueue.id, ArchivedQueue.name, ArchivedQueue.start_dt,
+                    ArchivedQueue.end_dt))
             queues = [(f'{q.name} [{q.start_dt.strftime("%d.%m.%Y %H:%M")} – '
                        f'{q.end_dt.strftime("%d.%m.%Y %H:%M")}]', q.id)
-                      for q in session.query(Queue).filter(Queue.status == status).all()]
-            if not queues:
-                context.bot.send_message(context.user_data['id'],
-                                         f'Очередей со статусом {status} пока нет!')
-                return menu(update, context)
-            context.user_data['last_queue_status'] = status
-            if not context.user_data.get('pagination'):
-                context.user_data['pagination'] = 1
-            markup, pages_count = build_pagination(
-                queues, PAGINATION_STEP, context.user_data['pagination'])
-            context.user_data['pages_count'] = pages_count
-            return (context.bot.send_message(
-                context.user_data['id'],
-                f'Найдено <b>{len(queues)} {STATUS_VERBOSES.get(status, "")}</b> очередей'
-                '\n\n<i>Для выбора страницы в пагинации также можно отправить её номер</i>',
-                reply_markup=markup, parse_mode=ParseMode.HTML),
-                    'queues')
+                      for q in query.order_by(Queue.id).offset(
+                          (page - 1) * PAGINATION_STEP).limit(PAGINATION_STEP)]
+        markup = build_pagination(queues, pages_count, page)
+        return (send_screen(
+            update, context,
+            f'Найдено <b>{total} {STATUS_VERBOSES.get(status, "")}</b> очередей'
+            '\n\n<i>Для выбора страницы в пагинации также можно отправить её номер</i>',
+            reply_markup=markup, parse_mode=ParseMode.HTML),
+                'queues')
 
     @staticmethod
     @delete_last_message
     def show(update: Update, context: CallbackContext):
+        page = None
         try:
             queue_id = int(context.match.string)
+            context.user_data.pop('card_page', None)
         except ValueError:
             try:
-                queue_id = int(context.match.string.split()[-1].strip())
+                parts = context.match.string.split()
+                if parts[0] == 'page':
+                    queue_id, page = int(parts[1]), int(parts[2])
+                    context.user_data['card_page'] = [queue_id, page]
+                else:
+                    queue_id = int(parts[-1].strip())
+                    # Refreshes and actions on the card keep the page it was turned to
+                    saved = context.user_data.get('card_page')
+                    if saved and saved[0] == queue_id:
+                        page = saved[1]
             except ValueError:
                 context.bot.send_message(context.user_data['id'], 'Что-то не так с переходом')
                 return menu(update, context)
-        with create_session() as session:
-            queue = session.query(Queue).get(queue_id)
-            if not queue:
-                context.bot.send_message(context.user_data['id'], 'Данной очереди не существует')
-                return menu(update, context)
-            buttons = [[InlineKeyboardButton('Обновить', callback_data=f'refresh {queue.id}'),
-                        InlineKeyboardButton('Вернуться назад', callback_data='back')]]
-            if (context.user_data['id'] not in [att.user_id for att in queue.attendants]
-                    and queue.status == 'active'):
-                buttons.insert(0, [InlineKeyboardButton('Встать в очередь', callback_data=queue_id)])
-            markup = InlineKeyboardMarkup(buttons)
-            text = []
-            for attr in Queue.verbose_attrs:
-                val = getattr(queue, attr)
-                if 'dt' in attr:
-                    val = val.strftime('%d.%m.%Y %H:%M:%S')
-                if attr == 'status':
-                    val = VIEW_STATUS_VERBOSES.get(val, val)
-                text.append(f'<b>{Queue.verbose_attrs.get(attr, attr)}:</b> {val}')
-            if queue.attendants:
-                text.append('')
-                for att in queue.attendants:
-                    att_str = f'{att.position}. {att.user.name} {att.user.surname}'
-                    if att.user_id == int(context.user_data['id']):
-                        att_str = f'<b>{att_str}</b>'
-                    text.append(att_str)
-            return (context.bot.send_message(
-                context.user_data['id'], '\n'.join(text),
-                parse_mode=ParseMode.HTML, reply_markup=markup), 'queue')
+        card = get_queue_card(queue_id)
+        if not card:
+            context.bot.send_message(context.user_data['id'], 'Данной очереди не существует')
+            return menu(update, context)
+        # Going back from a card opened outside of a list leads to the list of its status
+        context.user_data['last_queue_status'] = card.status
+        user = get_user(context.user_data['id'])
+        is_admin = bool(user and user.is_admin)
+        text, markup = render_queue_card(card, context.user_data['id'], is_admin,
+                                         delivery_summary(queue_id) if is_admin else (), page)
+        msg = send_screen(update, context, text, parse_mode=ParseMode.HTML, reply_markup=markup)
+        live_views.watch(context.user_data['id'], queue_id, msg.message_id,
+                         context.user_data['screen_hash'], page)
+        return msg, 'queue'
+
+    @staticmethod
+    @delete_last_message
+    def search(update: Update, context: CallbackContext):
+        q_name = update.message.text.strip()
+        suggestions = queue_search.search(q_name)
+        exact = next((suggestion for suggestion in suggestions
+                      if suggestion.name.strip().lower() == q_name.lower()), None)
+        if exact and exact.status == 'active':
+            context.user_data['queue_name'] = exact.name
+            return QueueView.register(update, context)
+        if not suggestions:
+            context.bot.send_message(context.user_data['id'], 'Такой очереди не нашлось')
+            return menu(update, context)
+        buttons = [[InlineKeyboardButton(
+            f'{suggestion.name} ({VIEW_STATUS_VERBOSES[suggestion.status].lower()})',
+            callback_data=f'{"reg" if suggestion.status == "active" else "show"} {suggestion.id}')]
+            for suggestion in suggestions]
+        buttons.append([InlineKeyboardButton('Вернуться назад', callback_data='back')])
+        return (send_screen(
+            update, context,
+            f'По запросу <b>{html.escape(q_name)}</b> нашлись очереди:'
+            '\n\n<i>Нажмите на активную очередь, чтобы встать в неё</i>',
+            reply_markup=InlineKeyboardMarkup(buttons), parse_mode=ParseMode.HTML), 'search')
 
     @staticmethod
     @delete_last_message
     def register(update: Update, context: CallbackContext):
         q_name = None
-        with create_session() as session:
+        with read_session() as session:
             if context.user_data.get('queue_name'):
                 q_name = context.user_data.pop('queue_name').strip()
                 queue = session.query(Queue).filter(
@@ -175,8 +197,7 @@ class QueueView:
                         context.bot.send_message(context.user_data['id'], 'Потерялся ID очереди...')
                         return menu(update, context)
                 queue = session.query(Queue).get(queue_id)
-            user = session.query(User).get(context.user_data['id'])
-            if not user:
+            if not get_user(context.user_data['id']):
                 return menu(update, context)
             if not queue:
                 context.bot.send_message(context.user_data['id'], 'Очередь пропала...')
@@ -184,22 +205,87 @@ class QueueView:
             if queue.status != 'active':
                 context.bot.send_message(context.user_data['id'], 'Очередь ещё не открыта')
                 return QueueView.show(update, context)
-            if user.id in [att.user_id for att in queue.attendants]:
-                context.bot.send_message(context.user_data['id'], 'Вы уже встали в эту очередь')
-                return QueueView.show(update, context)
-            att = Attendant(user_id=user.id, queue_id=queue.id, position=len(queue.attendants) + 1)
-            session.add(att)
-            session.commit()
-            queue.attendants.append(att)
-            session.add(queue)
-            session.commit()
-            context.bot.send_message(
-                context.user_data['id'], f'Вы успешно встали в очередь <b>{queue.name}</b>',
-                parse_mode=ParseMode.HTML)
-            try:
-                return QueueView.show(update, context)
-            except:
-                return menu(update, context)
+            queue_id, queue_name = queue.id, queue.name
+        status = pipeline.submit(context.user_data['id'], queue_id).wait()
+        if status == 'already':
+            context.bot.send_message(context.user_data['id'], 'Вы уже встали в эту очередь')
+            return QueueView.show(update, context)
+        if status == 'inactive':
+            context.bot.send_message(context.user_data['id'], 'Очередь ещё не открыта')
+            return QueueView.show(update, context)
+        if status != 'registered':
+            context.bot.send_message(context.user_data['id'],
+                                     'Не удалось встать в очередь, попробуйте ещё раз')
+            return menu(update, context)
+        context.bot.send_message(
+            context.user_data['id'], f'Вы успешно встали в очередь <b>{html.escape(queue_name)}</b>',
+            parse_mode=ParseMode.HTML)
+        try:
+            return QueueView.show(update, context)
+        except:
+            return menu(update, context)
+
+    @staticmethod
+    @delete_last_message
+    def leave(update: Update, context: CallbackContext):
+        queue_id = int(context.match.string.split()[-1])
+        status = leave(context.user_data['id'], queue_id)
+        if status == 'missing':
+            context.bot.send_message(context.user_data['id'], 'Очередь пропала...')
+            return menu(update, context)
+        if status == 'inactive':
+            context.bot.send_message(context.user_data['id'], 'Очередь уже закрыта')
+        elif status == 'absent':
+            context.bot.send_message(context.user_data['id'], 'Вас нет в этой очереди')
+        elif status == 'served':
+            context.bot.send_message(context.user_data['id'], 'Вас уже вызвали')
+        return QueueView.show(update, context)
+
+    @staticmethod
+    @delete_last_message
+    def swap(update: Update, context: CallbackContext):
+        queue_id = int(context.match.string.split()[-1])
+        status = swap_with_next(context.user_data['id'], queue_id)
+        if status == 'missing':
+            context.bot.send_message(context.user_data['id'], 'Очередь пропала...')
+            return menu(update, context)
+        if status == 'inactive':
+            context.bot.send_message(context.user_data['id'], 'Очередь уже закрыта')
+        elif status == 'absent':
+            context.bot.send_message(context.user_data['id'], 'Вас нет в этой очереди')
+        elif status == 'served':
+            context.bot.send_message(context.user_data['id'], 'Вас уже вызвали')
+        elif status == 'last':
+            context.bot.send_message(context.user_data['id'], 'За вами никого нет')
+        return QueueView.show(update, context)
+
+    @staticmethod
+    @delete_last_message
+    def advance(update: Update, context: CallbackContext):
+        user = get_user(context.user_data['id'])
+        if not user or not user.is_admin:
+            return menu(update, context)
+        queue_id = int(context.match.string.split()[-1])
+        status, upcoming = advance(queue_id)
+        if status == 'missing':
+            context.bot.send_message(context.user_data['id'], 'Очередь пропала...')
+            return menu(update, context)
+        if status == 'inactive':
+            context.bot.send_message(context.user_data['id'], 'Очередь уже закрыта')
+        elif status == 'empty':
+            context.bot.send_message(context.user_data['id'], 'В очереди никого нет')
+        if upcoming:
+            with read_session() as session:
+                queue_name = session.query(Queue.name).filter(Queue.id == queue_id).scalar()
+            # Only the few users right behind the head hear about the move
+            for ahead, user_id in enumerate(upcoming):
+                text = (f'Подошла ваша очередь в <b>{html.escape(queue_name)}</b>!' if not ahead else
+                        f'В очереди <b>{html.escape(queue_name)}</b> перед вами {ahead} чел.')
+                try:
+                    context.bot.send_message(user_id, text, parse_mode=ParseMode.HTML)
+                except TelegramError as e:
+                    print(f'[advance] {user_id=}: {e}')
+        return QueueView.show(update, context)
 
     @staticmethod
     def set_next_page(_, context):
@@ -224,11 +310,11 @@ class QueueView:
 class QueueAdd:
     @staticmethod
     @delete_last_message
-    def ask_name(_, context: CallbackContext):
+    def ask_name(update, context: CallbackContext):
         context.user_data['q_add_data'] = dict()
         markup = InlineKeyboardMarkup([[InlineKeyboardButton('Вернуться назад', callback_data='back')]])
-        return (context.bot.send_message(context.user_data['id'], 'Введите название очереди',
-                                         reply_markup=markup), 'QueueAdd.ask_name')
+        return (send_screen(update, context, 'Введите название очереди',
+                            reply_markup=markup), 'QueueAdd.ask_name')
 
     @staticmethod
     @delete_last_message
@@ -238,7 +324,7 @@ class QueueAdd:
         #         or not context.user_data['q_add_data'].get('name')):
         if not context.user_data['q_add_data'].get('name'):
             name = update.message.text
-            with create_session() as session:
+            with read_session() as session:
                 if session.query(Queue).filter(func.lower(Queue.name) == func.lower(name)).first():
                     context.bot.send_message(context.user_data['id'],
                                              f'Очередь с названием <b>{name}</b> уже существует',
@@ -246,9 +332,9 @@ class QueueAdd:
                     return QueueAdd.ask_name(update, context)
             context.user_data['q_add_data']['name'] = name
         markup = InlineKeyboardMarkup([[InlineKeyboardButton('Вернуться назад', callback_data='back')]])
-        return (context.bot.send_message(
-            context.user_data['id'], 'Введите дату и время открытия очереди\n'
-                                     'Формат: ДД.ММ.ГГГГ чч:мм:сс',
+        return (send_screen(
+            update, context, 'Введите дату и время открытия очереди\n'
+                             'Формат: ДД.ММ.ГГГГ чч:мм:сс',
             reply_markup=markup),
                 'QueueAdd.ask_start_dt')
 
@@ -260,15 +346,15 @@ class QueueAdd:
             if isinstance(start_dt, str):
                 context.bot.send_message(context.user_data['id'], start_dt)
                 return QueueAdd.ask_start_dt(update, context)
-            dt_now = datetime.utcnow() + timedelta(hours=3)
-            if start_dt < dt_now:
-                context.bot.send_message(context.user_data['id'], 'Не живите прошлым!')
+            error = check_start_dt(start_dt, local_now())
+            if error:
+                context.bot.send_message(context.user_data['id'], error)
                 return QueueAdd.ask_start_dt(update, context)
             context.user_data['q_add_data']['start_dt'] = start_dt.isoformat()
         markup = InlineKeyboardMarkup([[InlineKeyboardButton('Вернуться назад', callback_data='back')]])
-        return (context.bot.send_message(
-            context.user_data['id'], 'Введите дату и время закрытия очереди\n'
-                                     'Формат: ДД.ММ.ГГГГ чч:мм:сс',
+        return (send_screen(
+            update, context, 'Введите дату и время закрытия очереди\n'
+                             'Формат: ДД.ММ.ГГГГ чч:мм:сс',
             reply_markup=markup),
                 'QueueAdd.ask_end_dt')
 
@@ -281,15 +367,14 @@ class QueueAdd:
                 context.bot.send_message(context.user_data['id'], end_dt)
                 return QueueAdd.ask_end_dt(update, context)
             start_dt = datetime.fromisoformat(context.user_data['q_add_data']['start_dt'])
-            if (end_dt - start_dt).total_seconds() < MIN_DUR:
-                context.bot.send_message(
-                    context.user_data['id'],
-                    f'Очередь должна быть открыта хотя бы {MIN_DUR} секунд')
+            error = check_end_dt(start_dt, end_dt)
+            if error:
+                context.bot.send_message(context.user_data['id'], error)
                 return QueueAdd.ask_end_dt(update, context)
             context.user_data['q_add_data']['end_dt'] = end_dt.isoformat()
         markup = InlineKeyboardMarkup([[InlineKeyboardButton('Вернуться назад', callback_data='back')]])
-        return (context.bot.send_message(
-            context.user_data['id'],
+        return (send_screen(
+            update, context,
             'Введите дату и время оповещения о предстоящем открытии очереди\n'
             'Формат: ДД.ММ.ГГГГ чч:мм:сс', reply_markup=markup), 'QueueAdd.ask_notify_dt')
 
@@ -300,15 +385,10 @@ class QueueAdd:
         if isinstance(notify_dt, str):
             context.bot.send_message(context.user_data['id'], notify_dt)
             return QueueAdd.ask_notify_dt(update, context)
-        if notify_dt < datetime.utcnow() + timedelta(hours=3):
-            context.bot.send_message(context.user_data['id'], 'Не живите прошлым!')
-            return QueueAdd.ask_notify_dt(update, context)
         start_dt = datetime.fromisoformat(context.user_data['q_add_data']['start_dt'])
-        if (start_dt - notify_dt).total_seconds() <= MIN_DELTA:
-            context.bot.send_message(
-                context.user_data['id'],
-                f'Оповещение должно быть отправлено не позднее, '
-                f'чем за {MIN_DELTA} секунд до открытия очереди')
+        error = check_notify_dt(start_dt, notify_dt, local_now())
+        if error:
+            context.bot.send_message(context.user_data['id'], error)
             return QueueAdd.ask_notify_dt(update, context)
         end_dt = datetime.fromisoformat(context.user_data['q_add_data']['end_dt'])
         with create_session() as session:
@@ -318,17 +398,10 @@ class QueueAdd:
                       notify_dt=notify_dt)
             session.add(q)
             session.commit()
+            invalidate_status_counts()
             context.bot.send_message(
-                context.user_data['id'], f'Очередь <b>{q.name}</b> была успешно добавлена',
+                context.user_data['id'], f'Очередь <b>{html.escape(q.name)}</b> была успешно добавлена',
                 parse_mode=ParseMode.HTML)
-            context.job_queue.run_once(
-                notify_queue, (notify_dt - datetime.utcnow() - timedelta(hours=3)).total_seconds(),
-                context=context, name=str(q.id))
-            context.job_queue.run_once(
-                open_queue, (start_dt - datetime.utcnow() - timedelta(hours=3)).total_seconds(),
-                context=context, name=str(q.id))
-            context.job_queue.run_once(
-                close_queue, (end_dt - datetime.utcnow() - timedelta(hours=3)).total_seconds(),
-                context=context, name=str(q.id))
+        scheduler.wake()
         context.user_data.pop('q_add_data')
         return menu(update, context)
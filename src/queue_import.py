@@ -0,0 +1,211 @@
+import csv
+import html
+import io
+import re
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from telegram import Update, ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import CallbackContext
+
+from src.cache import get_user, invalidate_status_counts
+from src.constants import (TZ_OFFSET, QUEUE_IMPORT_MAX_SIZE, QUEUE_IMPORT_MAX_ROWS,
+                           QUEUE_IMPORT_NOTIFY_BEFORE)
+from src.db.db_session import create_session, read_session
+from src.db.models.queue import Queue
+from src.menu import menu
+from src.scheduler import scheduler
+from src.utils import (delete_last_message, parse_dt, local_now, send_screen, split_text,
+                       check_start_dt, check_end_dt, check_notify_dt)
+
+ImportRow = namedtuple('ImportRow', 'line name start_dt end_dt notify_dt error')
+
+_DURATION = re.compile(r'^([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+
+def parse_csv(text: str) -> list:
+    # Spreadsheets in a Russian locale export with semicolons
+    first_line = text.lstrip().split('\n', 1)[0]
+    delimiter = max(';,\t', key=first_line.count)
+    reader = csv.reader(io.StringIO(text), delimiter=delimiter)
+    rows = []
+    for record in reader:
+        record = [cell.strip() for cell in record]
+        if not any(record):
+            continue
+        if reader.line_num == 1 and record[0].lower() in ('name', 'название'):
+            continue
+        if len(record) < 4:
+            rows.append(ImportRow(reader.line_num, record[0], None, None, None,
+                                  'Ожидается 4 поля: название, открытие, закрытие, оповещение'))
+            continue
+        dts = [parse_dt(raw) for raw in record[1:4]]
+        error = next((dt for dt in dts if isinstance(dt, str)), None)
+        rows.append(ImportRow(reader.line_num, record[0], *((None,) * 3 if error else dts), error))
+    return rows
+
+
+def _unfold(text: str) -> list:
+    lines = []
+    for line in text.splitlines():
+        if line[:1] in (' ', '\t') and lines:
+            lines[-1] += line[1:]
+        elif line:
+            lines.append(line)
+    return lines
+
+
+def _ical_dt(value: str) -> datetime:
+    if len(value) == 8:
+        return datetime.strptime(value, '%Y%m%d')
+    dt = datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S')
+    # Floating and TZID times are taken as local, UTC ones are converted
+    return dt + TZ_OFFSET if value.endswith('Z') else dt
+
+
+def _ical_duration(value: str) -> timedelta:
+    match = _DURATION.match(value)
+    if not match:
+        raise ValueError(value)
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0),
+                         minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -duration if sign == '-' else duration
+
+
+def parse_ical(text: str) -> list:
+    rows, event, in_alarm = [], None, False
+    for line in _unfold(text):
+        key, _, value = line.partition(':')
+        name, *params = key.upper().split(';')
+        value = value.strip()
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event, in_alarm = {'line': len(rows) + 1}, False
+        elif event is None:
+            continue
+        elif name == 'BEGIN' and value.upper() == 'VALARM':
+            in_alarm = True
+        elif name == 'END' and value.upper() == 'VALARM':
+            in_alarm = False
+        elif name == 'END' and value.upper() == 'VEVENT':
+            rows.append(_ical_row(event))
+            event = None
+        elif in_alarm:
+            if name == 'TRIGGER' and 'trigger' not in event:
+                event['trigger'] = (value, 'VALUE=DATE-TIME' in params)
+        elif name in ('SUMMARY', 'DTSTART', 'DTEND', 'DURATION'):
+            event[name.lower()] = value.replace('\\,', ',').replace('\\;', ';')
+    return rows
+
+
+def _ical_row(event: dict) -> ImportRow:
+    name = event.get('summary', '')
+    try:
+        start_dt = _ical_dt(event['dtstart'])
+        if 'dtend' in event:
+            end_dt = _ical_dt(event['dtend'])
+        else:
+            end_dt = start_dt + _ical_duration(event['duration'])
+        trigger, absolute = event.get('trigger', (None, False))
+        if trigger is None:
+            notify_dt = start_dt - QUEUE_IMPORT_NOTIFY_BEFORE
+        elif absolute:
+            notify_dt = _ical_dt(trigger)
+        else:
+            notify_dt = start_dt + _ical_duration(trigger)
+    except (KeyError, ValueError):
+        return ImportRow(event['line'], name, None, None, None, 'Неверный формат даты')
+    return ImportRow(event['line'], name, start_dt, end_dt, notify_dt, None)
+
+
+def validate(rows: list, now: datetime) -> list:
+    names = {row.name for row in rows if row.name}
+    existing = set()
+    if names:
+        with read_session() as session:
+            existing = {name.lower() for name, in session.query(Queue.name).filter(
+                func.lower(Queue.name).in_([func.lower(name) for name in names]))}
+    seen, report = set(), []
+    for row in rows:
+        error = row.error
+        if not error and not row.name:
+            error = 'Не указано название'
+        elif not error and row.name.lower() in existing:
+            error = 'Очередь с таким названием уже существует'
+        elif not error and row.name.lower() in seen:
+            error = 'Название повторяется в файле'
+        error = (error or check_start_dt(row.start_dt, now) or check_end_dt(row.start_dt, row.end_dt)
+                 or check_notify_dt(row.start_dt, row.notify_dt, now))
+        if not error:
+            seen.add(row.name.lower())
+        report.append((row, error))
+    return report
+
+
+def import_queues(rows: list, now: datetime = None) -> list:
+    report = validate(rows, now or local_now())
+    mappings = [{'name': row.name, 'start_dt': row.start_dt, 'end_dt': row.end_dt,
+                 'notify_dt': row.notify_dt, 'status': 'planned', 'notification_sent': False}
+                for row, error in report if not error]
+    if mappings:
+        with create_session() as session:
+            session.bulk_insert_mappings(Queue, mappings)
+            session.commit()
+        invalidate_status_counts()
+        # Transitions are read from the queue table, so one wake-up schedules the whole batch
+        scheduler.wake()
+    return report
+
+
+class QueueImport:
+    @staticmethod
+    @delete_last_message
+    def ask_file(update: Update, context: CallbackContext):
+        if update.message is not None:
+            context.user_data['id'] = str(update.message.from_user.id)
+        user = get_user(context.user_data.get('id'))
+        if not user or not user.is_admin:
+            return menu(update, context)
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton('Вернуться назад', callback_data='back')]])
+        return (send_screen(
+            update, context,
+            'Отправьте CSV или iCalendar (.ics) файл с очередями\n\n'
+            'CSV: <i>название, открытие, закрытие, оповещение</i>, '
+            'даты в формате ДД.ММ.ГГГГ чч:мм:сс\n'
+            'iCalendar: событие на каждую очередь, оповещение берётся из напоминания '
+            f'или за {int(QUEUE_IMPORT_NOTIFY_BEFORE.total_seconds() // 60)} минут до открытия',
+            reply_markup=markup, parse_mode=ParseMode.HTML), 'QueueImport.ask_file')
+
+    @staticmethod
+    @delete_last_message
+    def finish(update: Update, context: CallbackContext):
+        document = update.message.document
+        if document.file_size and document.file_size > QUEUE_IMPORT_MAX_SIZE:
+            context.bot.send_message(context.user_data['id'], 'Файл слишком большой')
+            return QueueImport.ask_file(update, context)
+        data = bytes(context.bot.get_file(document.file_id).download_as_bytearray())
+        try:
+            text = data.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            text = data.decode('cp1251', errors='replace')
+        is_ical = ((document.file_name or '').lower().endswith('.ics')
+                   or document.mime_type == 'text/calendar' or 'BEGIN:VCALENDAR' in text[:1024])
+        rows = parse_ical(text) if is_ical else parse_csv(text)
+        if not rows:
+            context.bot.send_message(context.user_data['id'], 'В файле не найдено ни одной очереди')
+            return QueueImport.ask_file(update, context)
+        if len(rows) > QUEUE_IMPORT_MAX_ROWS:
+            context.bot.send_message(context.user_data['id'],
+                                     f'Можно импортировать не больше {QUEUE_IMPORT_MAX_ROWS} очередей')
+            return QueueImport.ask_file(update, context)
+        report = import_queues(rows)
+        added = sum(1 for _, error in report if not error)
+        lines = [f'<b>Добавлено очередей:</b> {added} из {len(report)}']
+        label = 'Событие' if is_ical else 'Строка'
+        for row, error in report:
+            lines.append(f'{label} {row.line}: <b>{html.escape(row.name or "—")}</b> – '
+                         f'{html.escape(error) if error else "добавлена"}')
+        for chunk in split_text(lines):
+            context.bot.send_message(context.user_data['id'], chunk, parse_mode=ParseMode.HTML)
+        return menu(update, context)
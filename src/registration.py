@@ -0,0 +1,216 @@
+import time
+from collections import deque
+from queue import Queue as RequestQueue, Empty
+from threading import Thread, Event, Lock
+
+from sqlalchemy import func
+
+from src.cache import bump_queue_version
+from src.constants import (REGISTRATION_BATCH_INTERVAL, REGISTRATION_MAX_BATCH,
+                           REGISTRATION_TIMEOUT, POSITION_GAP, QUEUE_NOTIFY_AHEAD)
+from src.db.db_session import create_session
+from src.db.models.attendant import Attendant
+from src.db.models.queue import Queue
+from src.utils import local_now
+
+
+class RegistrationRequest:
+    __slots__ = ('user_id', 'queue_id', 'submitted', 'done', 'status', 'position')
+
+    def __init__(self, user_id: str, queue_id: int):
+        self.user_id = user_id
+        self.queue_id = queue_id
+        self.submitted = time.monotonic()
+        self.done = Event()
+        self.status = None
+        self.position = None
+
+    def resolve(self, status: str, position: int = None):
+        self.status = status
+        self.position = position
+        self.done.set()
+
+    def wait(self, timeout: float = REGISTRATION_TIMEOUT) -> str:
+        if not self.done.wait(timeout):
+            return 'timeout'
+        return self.status
+
+
+class RegistrationPipeline:
+    def __init__(self, interval: float = REGISTRATION_BATCH_INTERVAL,
+                 max_batch: int = REGISTRATION_MAX_BATCH):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._requests = RequestQueue()
+        self._latencies = deque(maxlen=5000)
+        self._lock = Lock()
+        self._thread = None
+        self._running = False
+
+    def submit(self, user_id: str, queue_id: int) -> RegistrationRequest:
+        with self._lock:
+            if self._thread is None:
+                self._running = True
+                self._thread = Thread(target=self._run, name='registration', daemon=True)
+                self._thread.start()
+        request = RegistrationRequest(str(user_id), queue_id)
+        self._requests.put(request)
+        return request
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._running = False
+            self._requests.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def percentile(self, p: float) -> float:
+        latencies = sorted(self._latencies)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+    def _run(self):
+        while self._running or not self._requests.empty():
+            request = self._requests.get()
+            if request is None:
+                continue
+            batch = [request]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._requests.get(timeout=timeout)
+                except Empty:
+                    break
+                if request is None:
+                    self._running = False
+                    break
+                batch.append(request)
+            try:
+                self._commit(batch)
+            except Exception as e:
+                print(f'[registration] Batch of {len(batch)} failed: {e}')
+                for request in batch:
+                    if not request.done.is_set():
+                        request.resolve('error')
+            now = time.monotonic()
+            self._latencies.extend(now - request.submitted for request in batch)
+
+    @staticmethod
+    def _commit(batch: list):
+        by_queue = {}
+        for request in batch:
+            by_queue.setdefault(request.queue_id, []).append(request)
+        results = []
+        with create_session() as session:
+            for queue_id, requests in by_queue.items():
+                queue = session.query(Queue).filter(Queue.id == queue_id).with_for_update().first()
+                if not queue:
+                    results.extend((request, 'missing', None) for request in requests)
+                    continue
+                if queue.status != 'active':
+                    results.extend((request, 'inactive', None) for request in requests)
+                    continue
+                user_ids = {request.user_id for request in requests}
+                registered = {row.user_id: row.position for row in session.query(
+                    Attendant.user_id, Attendant.position).filter(
+                    (Attendant.queue_id == queue_id) & Attendant.user_id.in_(user_ids))}
+                position = session.query(func.max(Attendant.position)).filter(
+                    Attendant.queue_id == queue_id).scalar() or 0
+                for request in requests:
+                    if request.user_id in registered:
+                        results.append((request, 'already', registered[request.user_id]))
+                        continue
+                    position += POSITION_GAP
+                    registered[request.user_id] = position
+                    session.add(Attendant(user_id=request.user_id, queue_id=queue_id,
+                                          position=position))
+                    results.append((request, 'registered', position))
+            session.commit()
+        for queue_id in {request.queue_id for request, status, _ in results if status == 'registered'}:
+            bump_queue_version(queue_id)
+        for request, status, position in results:
+            request.resolve(status, position)
+
+
+pipeline = RegistrationPipeline()
+
+
+def _lock_active_queue(session, queue_id: int):
+    # Serialises with the registration pipeline, which locks the same row
+    queue = session.query(Queue).filter(Queue.id == queue_id).with_for_update().first()
+    if not queue:
+        return 'missing'
+    if queue.status != 'active':
+        return 'inactive'
+    return None
+
+
+def leave(user_id: str, queue_id: int) -> str:
+    with create_session() as session:
+        error = _lock_active_queue(session, queue_id)
+        if error:
+            return error
+        # Positions behind the removed row keep their order, so nothing is renumbered
+        attendant = session.query(Attendant).filter(
+            (Attendant.queue_id == queue_id) & (Attendant.user_id == str(user_id))).first()
+        if not attendant:
+            return 'absent'
+        if attendant.served_dt is not None:
+            return 'served'
+        session.delete(attendant)
+        session.commit()
+    bump_queue_version(queue_id)
+    return 'left'
+
+
+def swap_with_next(user_id: str, queue_id: int) -> str:
+    with create_session() as session:
+        error = _lock_active_queue(session, queue_id)
+        if error:
+            return error
+        attendant = session.query(Attendant).filter(
+            (Attendant.queue_id == queue_id) & (Attendant.user_id == str(user_id))).first()
+        if not attendant:
+            return 'absent'
+        if attendant.served_dt is not None:
+            return 'served'
+        behind = session.query(Attendant).filter(
+            (Attendant.queue_id == queue_id) & (Attendant.position > attendant.position)
+            & Attendant.served_dt.is_(None)).order_by(Attendant.position).first()
+        if not behind:
+            return 'last'
+        # Park one row on a free negative key so the unique index never sees a duplicate
+        position, behind_position = attendant.position, behind.position
+        attendant.position = -position
+        session.flush()
+        behind.position = position
+        session.flush()
+        attendant.position = behind_position
+        session.commit()
+    bump_queue_version(queue_id)
+    return 'swapped'
+
+
+def advance(queue_id: int) -> tuple:
+    # Only the rows right behind the head are read, they are the ones to be told about their turn
+    with create_session() as session:
+        error = _lock_active_queue(session, queue_id)
+        if error:
+            return error, []
+        rows = session.query(Attendant).filter(
+            (Attendant.queue_id == queue_id) & Attendant.served_dt.is_(None)).order_by(
+            Attendant.position).limit(QUEUE_NOTIFY_AHEAD + 1).all()
+        if not rows:
+            return 'empty', []
+        # The head is marked served rather than removed, so the attendance is kept
+        rows[0].served_dt = local_now()
+        session.commit()
+        upcoming = [row.user_id for row in rows[1:]]
+    bump_queue_version(queue_id)
+    return 'advanced', upcoming
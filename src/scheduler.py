@@ -0,0 +1,99 @@
+from threading import Thread, Event
+
+from sqlalchemy import func
+
+from src.constants import SCHEDULER_POLL_INTERVAL, SCHEDULER_BATCH
+from src.db.db_session import read_session
+from src.db.models.queue import Queue
+from src.metrics import metrics
+from src.utils import local_now
+
+# Transitions in the order they happen to a queue. Every condition only matches queues that
+# still have to make that transition, so replaying a batch after a crash is harmless.
+TRANSITIONS = (
+    ('notify', Queue.notify_dt,
+     lambda now: (Queue.status == 'planned') & (Queue.notification_sent.isnot(True)) &
+                 (Queue.start_dt > now)),
+    ('open', Queue.start_dt,
+     lambda now: (Queue.status == 'planned') & (Queue.end_dt > now)),
+    ('close', Queue.end_dt,
+     lambda now: Queue.status.in_(('planned', 'active'))),
+)
+
+
+class Scheduler:
+    def __init__(self, poll_interval: float = SCHEDULER_POLL_INTERVAL,
+                 batch_size: int = SCHEDULER_BATCH):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.bot = None
+        self.handlers = {}
+        self._wake = Event()
+        self._stop = Event()
+        self._thread = None
+
+    def start(self, bot, handlers: dict):
+        self.bot = bot
+        self.handlers = handlers
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = Thread(target=self._run, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wake(self):
+        self._wake.set()
+
+    def due_events(self, now) -> list:
+        events = []
+        with read_session() as session:
+            for event, column, condition in TRANSITIONS:
+                events.extend((column_dt, event, queue_id) for queue_id, column_dt in session.query(
+                    Queue.id, column).filter(condition(now) & (column <= now)).order_by(
+                    column).limit(self.batch_size))
+        return sorted(events)[:self.batch_size]
+
+    def next_due(self, now):
+        with read_session() as session:
+            due = [session.query(func.min(column)).filter(condition(now) & (column > now)).scalar()
+                   for _, column, condition in TRANSITIONS]
+        due = [dt for dt in due if dt is not None]
+        return min(due) if due else None
+
+    def run_pending(self) -> int:
+        processed = 0
+        for due_dt, event, queue_id in self.due_events(local_now()):
+            if self._stop.is_set():
+                break
+            metrics.observe('scheduler_lag_seconds', (local_now() - due_dt).total_seconds(),
+                            event=event)
+            try:
+                self.handlers[event](self.bot, queue_id)
+                processed += 1
+            except Exception as e:
+                print(f'[scheduler] {event} on {queue_id=} failed: {e}')
+        return processed
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                if self.run_pending():
+                    continue
+                next_dt = self.next_due(local_now())
+            except Exception as e:
+                print(f'[scheduler] {e}')
+                next_dt = None
+            timeout = self.poll_interval
+            if next_dt is not None:
+                timeout = min(timeout, max((next_dt - local_now()).total_seconds(), 0))
+            self._wake.wait(timeout)
+
+
+scheduler = Scheduler()
@@ -0,0 +1,186 @@
+import difflib
+from bisect import bisect_left
+from collections import namedtuple
+from threading import Lock
+
+from sqlalchemy import func, case, literal
+
+from src.cache import add_status_listener
+from src.constants import SEARCH_LIMIT
+from src.db.db_session import read_session, get_engine
+from src.db.migrations import has_extension
+from src.db.models.archived_queue import ArchivedQueue
+from src.db.models.queue import Queue
+
+Suggestion = namedtuple('Suggestion', 'id name status score')
+
+_RANKS = {'active': 0, 'planned': 1, 'archived': 2}
+
+
+def _normalize(name: str) -> str:
+    return ' '.join(name.lower().split())
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+class QueueSearch:
+    def __init__(self, limit: int = SEARCH_LIMIT):
+        self.limit = limit
+        self._mode = None
+        self._lock = Lock()
+        self._build_lock = Lock()
+        self._index = None
+        self._archive = None
+        self._generation = 0
+        # Queues are added, opened, closed and compacted only along with a status count change
+        add_status_listener(self.invalidate)
+
+    @property
+    def mode(self) -> str:
+        if self._mode is None:
+            engine = get_engine()
+            if engine.dialect.name != 'postgresql':
+                self._mode = 'memory'
+            else:
+                with engine.connect() as conn:
+                    self._mode = 'trigram' if has_extension('pg_trgm')(conn) else 'prefix'
+        return self._mode
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._index = None
+
+    def search(self, query: str) -> list:
+        query = _normalize(query)
+        if not query:
+            return []
+        if self.mode == 'memory':
+            return self._search_memory(query)
+        return self._search_db(query)
+
+    def _search_db(self, query: str) -> list:
+        prefix = _escape_like(query) + '%'
+        suggestions = []
+        with read_session() as session:
+            # Live queues first, the archive is only read when they do not fill the list
+            for model in (Queue, ArchivedQueue):
+                lowered = func.lower(model.name)
+                is_prefix = lowered.like(prefix, escape='\\')
+                if self.mode == 'trigram':
+                    condition = lowered.op('%')(query) | is_prefix
+                    score = func.similarity(lowered, query)
+                else:
+                    condition = is_prefix
+                    if model is Queue:
+                        condition |= lowered.like('% ' + prefix, escape='\\')
+                    score = literal(0.5)
+                score = case((is_prefix, 1 + score), else_=score)
+                if model is Queue:
+                    status = Queue.status
+                    order = (case(_RANKS, value=Queue.status, else_=len(_RANKS)), score.desc())
+                else:
+                    status = literal('archived')
+                    order = (score.desc(),)
+                rows = session.query(model.id, model.name, status, score).filter(condition).order_by(
+                    *order, model.id.desc()).limit(self.limit - len(suggestions)).all()
+                suggestions.extend(Suggestion(*row) for row in rows)
+                if len(suggestions) >= self.limit:
+                    break
+        return suggestions
+
+    @staticmethod
+    def _add(keys: tuple, names: dict, rows):
+        full, words = keys
+        for queue_id, name, status in rows:
+            if not name:
+                continue
+            names[queue_id] = (name, status)
+            normalized = _normalize(name)
+            full.append((normalized, queue_id))
+            for i in range(1, len(normalized)):
+                if normalized[i - 1] == ' ':
+                    words.append((normalized[i:], queue_id))
+        full.sort()
+        words.sort()
+
+    def _build(self) -> tuple:
+        # Per status: sorted (name, id) keys and sorted (word start, id) keys
+        index = tuple(([], []) for _ in range(len(_RANKS)))
+        names = {}
+        with read_session() as session:
+            rows = session.query(Queue.id, Queue.name, Queue.status).all()
+            # The compacted archive only grows, so its part is rebuilt only when it did
+            archive_version = tuple(session.query(func.count(ArchivedQueue.id),
+                                                  func.max(ArchivedQueue.id)).one())
+            archive = self._archive
+            if archive is None or archive[0] != archive_version:
+                archive_keys, archive_names = ([], []), {}
+                self._add(archive_keys, archive_names, (
+                    (queue_id, name, 'archived') for queue_id, name in session.query(
+                        ArchivedQueue.id, ArchivedQueue.name)))
+                archive = self._archive = archive_version, archive_keys, archive_names
+        by_status = {}
+        for row in rows:
+            by_status.setdefault(_RANKS.get(row.status, len(_RANKS) - 1), []).append(row)
+        for rank, status_rows in by_status.items():
+            self._add(index[rank], names, status_rows)
+        for keys, archive_keys in zip(index[-1], archive[1]):
+            keys[:0] = archive_keys
+            if len(keys) > len(archive_keys):
+                keys.sort()
+        names.update(archive[2])
+        return index, names
+
+    def _get_index(self) -> tuple:
+        index = self._index
+        if index is not None:
+            return index
+        # One thread rebuilds, the others wait for its result instead of repeating the work
+        with self._build_lock:
+            index = self._index
+            if index is not None:
+                return index
+            generation = self._generation
+            index = self._build()
+            with self._lock:
+                if generation == self._generation:
+                    self._index = index
+        return index
+
+    def _search_memory(self, query: str) -> list:
+        index, names = self._get_index()
+        suggestions, seen = [], set()
+        for keys in index:
+            for score, entries in zip((1.5, 0.5), keys):
+                i = bisect_left(entries, (query,))
+                while (i < len(entries) and entries[i][0].startswith(query)
+                       and len(suggestions) < self.limit):
+                    queue_id = entries[i][1]
+                    if queue_id not in seen:
+                        seen.add(queue_id)
+                        suggestions.append(Suggestion(queue_id, *names[queue_id], score))
+                    i += 1
+        if suggestions:
+            return suggestions
+        # Typos are forgiven on live queues only, the archive is too big to compare against.
+        # Names and their words are cut to the query length, so a short query can match them.
+        live = {}
+        for keys in index[:-1]:
+            for entries in keys:
+                for key, queue_id in entries:
+                    live.setdefault(key[:len(query) + 1].rstrip(), []).append(queue_id)
+        matcher = difflib.SequenceMatcher(b=query)
+        for key in difflib.get_close_matches(query, live, self.limit):
+            matcher.set_seq1(key)
+            for queue_id in live[key]:
+                if queue_id not in seen:
+                    seen.add(queue_id)
+                    suggestions.append(Suggestion(queue_id, *names[queue_id], matcher.ratio()))
+        suggestions.sort(key=lambda suggestion: (_RANKS[suggestion.status], -suggestion.score))
+        return suggestions[:self.limit]
+
+
+queue_search = QueueSearch()
@@ -1,17 +1,29 @@
-import json
+import html
+import os
+import zlib
 from datetime import datetime
+from functools import wraps
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest
 from telegram.ext import CallbackContext
 
-from src.db.db_session import create_session
-from src.db.models.state import State
+from src.constants import VIEW_STATUS_VERBOSES, TZ_OFFSET, MIN_DUR, MIN_DELTA, MESSAGE_LIMIT
+from src.db.models.queue import Queue
 
 
 def delete_last_message(func):
+    @wraps(func)
     def wrapper(update, context: CallbackContext):
-        if context.user_data.get('message_id'):
+        outermost = not hasattr(context, 'editable_message_id')
+        if outermost:
+            context.editable_message_id = None
+            query = getattr(update, 'callback_query', None)
+            if (os.getenv('edit_screens', '1') != '0' and query and query.message
+                    and query.message.message_id == context.user_data.get('message_id')):
+                # The screen the button belongs to is edited by send_screen instead
+                context.editable_message_id = query.message.message_id
+        if context.user_data.get('message_id') and not context.editable_message_id:
             try:
                 context.bot.deleteMessage(context.user_data['id'], context.user_data.pop('message_id'))
             except BadRequest:
@@ -19,11 +31,14 @@ def delete_last_message(func):
         while context.user_data.get('messages_to_delete'):
             context.bot.deleteMessage(context.user_data['id'],
                                       context.user_data['messages_to_delete'].pop(0))
-        output = func(update, context)
+        try:
+            output = func(update, context)
+        finally:
+            if outermost:
+                del context.editable_message_id
         if isinstance(output, tuple):
             msg, callback = output
             context.user_data['message_id'] = msg.message_id
-            save_state(context.user_data['id'], callback, context.user_data)
         else:
             callback = output
         return callback
@@ -31,30 +46,43 @@ def delete_last_message(func):
     return wrapper
 
 
-def save_state(user_id: str, callback: str, data: dict):
-    with create_session() as session:
-        state = session.query(State).get(user_id)
-        str_data = json.dumps(data)
-        if state:
-            state.user_id = user_id
-            state.callback = callback
-            state.data = str_data
-        else:
-            state = State(user_id=user_id, callback=callback, data=str_data)
-        session.add(state)
-        session.commit()
-
-
-def build_pagination(array: list, pag_step: int, current_page: int):
-    array_length = len(array)
-    pages_count = (
-        array_length // pag_step if array_length / pag_step == array_length // pag_step
-        else array_length // pag_step + 1)
-    if current_page > pages_count:
-        current_page = pages_count
-    start = (current_page - 1) * pag_step
-    end = current_page * pag_step if current_page * pag_step <= array_length else array_length
-    buttons = [[InlineKeyboardButton(elem[0], callback_data=elem[1])] for elem in array[start:end]]
+def get_screen_hash(text: str, reply_markup=None) -> int:
+    return zlib.crc32(f'{text}{reply_markup.to_json() if reply_markup else ""}'.encode())
+
+
+def send_screen(update, context: CallbackContext, text: str, reply_markup=None, parse_mode=None):
+    screen_hash = get_screen_hash(text, reply_markup)
+    message_id = getattr(context, 'editable_message_id', None)
+    if message_id:
+        if context.user_data.get('screen_hash') == screen_hash:
+            return update.callback_query.message
+        try:
+            msg = context.bot.edit_message_text(text, context.user_data['id'], message_id,
+                                                reply_markup=reply_markup, parse_mode=parse_mode)
+            context.user_data['screen_hash'] = screen_hash
+            return msg
+        except BadRequest as e:
+            if 'not modified' in str(e):
+                context.user_data['screen_hash'] = screen_hash
+                return update.callback_query.message
+            try:
+                context.bot.deleteMessage(context.user_data['id'], message_id)
+            except BadRequest:
+                pass
+        finally:
+            context.editable_message_id = None
+    msg = context.bot.send_message(context.user_data['id'], text, reply_markup=reply_markup,
+                                   parse_mode=parse_mode)
+    context.user_data['screen_hash'] = screen_hash
+    return msg
+
+
+def count_pages(total: int, pag_step: int) -> int:
+    return max(1, -(-total // pag_step))
+
+
+def build_pagination(page: list, pages_count: int, current_page: int):
+    buttons = [[InlineKeyboardButton(elem[0], callback_data=elem[1])] for elem in page]
     if pages_count > 1:
         pag_block = [InlineKeyboardButton(f'{current_page}/{pages_count}', callback_data='refresh')]
         if current_page > 1:
@@ -63,7 +91,96 @@ def build_pagination(array: list, pag_step: int, current_page: int):
             pag_block.append(InlineKeyboardButton('»', callback_data='next_page'))
         buttons.append(pag_block)
     buttons.append([InlineKeyboardButton('Вернуться назад', callback_data='back')])
-    return InlineKeyboardMarkup(buttons), pages_count
+    return InlineKeyboardMarkup(buttons)
+
+
+def format_queue_info(queue: Queue) -> list:
+    text = []
+    for attr in Queue.verbose_attrs:
+        val = getattr(queue, attr)
+        if 'dt' in attr:
+            val = val.strftime('%d.%m.%Y %H:%M:%S')
+        elif attr == 'status':
+            val = VIEW_STATUS_VERBOSES.get(val, val)
+        else:
+            val = html.escape(str(val))
+        text.append(f'<b>{Queue.verbose_attrs.get(attr, attr)}:</b> {val}')
+    return text
+
+
+def _attendant_lines(card, user_id: str):
+    # Served users keep their place in the history, ordinals count only those still waiting
+    ordinal = 0
+    for att_user_id, att_name, served in card.attendants:
+        if served:
+            att_str = f'✓ {html.escape(att_name)}'
+        else:
+            ordinal += 1
+            att_str = f'{ordinal}. {html.escape(att_name)}'
+        yield f'<b>{att_str}</b>' if att_user_id == user_id else att_str
+
+
+def render_queue_card(card, user_id: str, is_admin: bool = False, footer=(), page: int = None):
+    buttons = [[InlineKeyboardButton('Обновить', callback_data=f'refresh {card.queue_id}'),
+                InlineKeyboardButton('Вернуться назад', callback_data='back')]]
+    waiting = [att_user_id for att_user_id, _, served in card.attendants if not served]
+    if card.status == 'active':
+        actions = []
+        if user_id not in card.user_ids:
+            actions.append(InlineKeyboardButton('Встать в очередь', callback_data=card.queue_id))
+        elif user_id in waiting:
+            actions.append(InlineKeyboardButton('Покинуть очередь',
+                                                callback_data=f'leave {card.queue_id}'))
+            if waiting[-1] != user_id:
+                actions.append(InlineKeyboardButton('Пропустить вперёд',
+                                                    callback_data=f'swap {card.queue_id}'))
+        buttons.insert(0, actions)
+        if is_admin and waiting:
+            buttons.insert(1, [InlineKeyboardButton('Следующий',
+                                                    callback_data=f'next {card.queue_id}')])
+    if is_admin and card.attendants:
+        buttons.insert(-1, [InlineKeyboardButton('Выгрузить CSV',
+                                                 callback_data=f'export {card.queue_id}')])
+    text = list(card.header)
+    if card.attendants:
+        # Big queues are split into pages that fit one message, by default the page with the
+        # user's own row or, for everyone else, the head of the line
+        budget = max(MESSAGE_LIMIT - len('\n'.join(text)) - len('\n'.join(footer)) - 3,
+                     MESSAGE_LIMIT // 4)
+        own = None
+        if page is None:
+            target = user_id if user_id in waiting else (waiting[0] if waiting else None)
+            own = next((i for i, (att_user_id, _, _) in enumerate(card.attendants)
+                        if att_user_id == target), None)
+        shown, current, pages_count, seen = None, 1, 0, 0
+        for lines in iter_pages(_attendant_lines(card, user_id), budget):
+            pages_count += 1
+            first, seen = seen, seen + len(lines)
+            # A page past the end shows the last one
+            chosen = (own is not None and first <= own < seen if page is None
+                      else pages_count <= page)
+            if chosen or shown is None:
+                shown, current = lines, pages_count
+        text.append('')
+        text.extend(shown)
+        if pages_count > 1:
+            pag_block = [InlineKeyboardButton(f'{current}/{pages_count}',
+                                              callback_data=f'page {card.queue_id} {current}')]
+            if current > 1:
+                pag_block.insert(0, InlineKeyboardButton(
+                    '«', callback_data=f'page {card.queue_id} {current - 1}'))
+            if current < pages_count:
+                pag_block.append(InlineKeyboardButton(
+                    '»', callback_data=f'page {card.queue_id} {current + 1}'))
+            buttons.insert(-1, pag_block)
+    if footer:
+        text.append('')
+        text.extend(footer)
+    return '\n'.join(text), InlineKeyboardMarkup(buttons)
+
+
+def local_now() -> datetime:
+    return datetime.utcnow() + TZ_OFFSET
 
 
 def parse_dt(raw_str: str) -> datetime:
@@ -73,4 +190,40 @@ def parse_dt(raw_str: str) -> datetime:
         hour, minute, second = map(int, t.split(':'))
         return datetime(year, month, day, hour, minute, second)
     except ValueError:
-        return 'Неверный формат даты'
\ No newline at end of file
+        return 'Неверный формат даты'
+
+
+def check_start_dt(start_dt: datetime, now: datetime):
+    if start_dt < now:
+        return 'Не живите прошлым!'
+
+
+def check_end_dt(start_dt: datetime, end_dt: datetime):
+    if (end_dt - start_dt).total_seconds() < MIN_DUR:
+        return f'Очередь должна быть открыта хотя бы {MIN_DUR} секунд'
+
+
+def check_notify_dt(start_dt: datetime, notify_dt: datetime, now: datetime):
+    if notify_dt < now:
+        return 'Не живите прошлым!'
+    if (start_dt - notify_dt).total_seconds() <= MIN_DELTA:
+        return (f'Оповещение должно быть отправлено не позднее, '
+                f'чем за {MIN_DELTA} секунд до открытия очереди')
+
+
+def iter_pages(lines, limit: int = MESSAGE_LIMIT):
+    # Packs lines into pages as they come, so only one page is held at a time
+    page, size = [], 0
+    for line in lines:
+        line = line[:limit]
+        if page and size + len(line) > limit:
+            yield page
+            page, size = [], 0
+        page.append(line)
+        size += len(line) + 1
+    if page:
+        yield page
+
+
+def split_text(lines: list, limit: int = MESSAGE_LIMIT) -> list:
+    return ['\n'.join(page) for page in iter_pages(lines, limit)]
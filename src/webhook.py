@@ -0,0 +1,91 @@
+import hmac
+import json
+import signal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue as UpdateQueue, Full
+from threading import Thread, Event
+
+from telegram import Update
+
+from src.cluster import FORWARDED_HEADER
+from src.constants import WEBHOOK_QUEUE_SIZE, WEBHOOK_PUT_TIMEOUT
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    server: 'WebhookServer'
+
+    def do_POST(self):
+        if self.path.split('?')[0] != self.server.path:
+            return self._reply(404)
+        secret = self.server.secret
+        if not hmac.compare_digest(
+                self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), secret):
+            return self._reply(403)
+        if self.server.draining.is_set():
+            return self._reply(503)
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            update = Update.de_json(json.loads(body), self.server.dispatcher.bot)
+        except (ValueError, TypeError, KeyError):
+            return self._reply(400)
+        cluster = self.server.cluster
+        if cluster is not None and not self.headers.get(FORWARDED_HEADER):
+            owner = cluster.owner(update)
+            if owner != cluster.worker_index:
+                # Every user is served by one worker, which keeps their updates in order
+                return self._reply(cluster.forward(owner, body, self.server.path, secret))
+        try:
+            self.server.dispatcher.update_queue.put(update, timeout=WEBHOOK_PUT_TIMEOUT)
+        except Full:
+            # Telegram redelivers the update later, so nothing is lost
+            return self._reply(503)
+        self._reply(200)
+
+    def _reply(self, code: int):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, dispatcher, host: str, port: int, path: str, secret: str,
+                 queue_size: int = WEBHOOK_QUEUE_SIZE, cluster=None):
+        # Without the secret anyone could post updates on behalf of any user, admins included.
+        # It is not generated here, every worker has to share the one given to Telegram.
+        if not secret:
+            raise ValueError('Webhook mode needs webhook_secret')
+        super().__init__((host, port), WebhookHandler)
+        self.dispatcher = dispatcher
+        self.cluster = cluster if cluster is not None and cluster.enabled else None
+        self.path = '/' + path.strip('/')
+        self.secret = secret
+        self.draining = Event()
+        dispatcher.update_queue = UpdateQueue(maxsize=queue_size)
+
+    def start(self, url: str = None):
+        Thread(target=self.dispatcher.start, name='dispatcher', daemon=True).start()
+        Thread(target=self.serve_forever, name='webhook', daemon=True).start()
+        if url and (self.cluster is None or self.cluster.worker_index == 0):
+            self.dispatcher.bot.set_webhook(url.rstrip('/') + self.path, secret_token=self.secret)
+        print(f'[webhook] Listening on {self.server_address[0]}:{self.server_address[1]}{self.path}')
+
+    def stop(self):
+        self.draining.set()
+        self.shutdown()
+        self.server_close()
+        # The dispatcher only stops once its queue is empty, so accepted updates are all handled
+        self.dispatcher.stop()
+
+    def idle(self):
+        stop_signal = Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop_signal.set())
+        while not stop_signal.wait(1):
+            pass
+        self.stop()